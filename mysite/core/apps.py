@@ -1,5 +1,11 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class CoreConfig(AppConfig):
     name = 'core'
+
+    def ready(self):
+        from core import search, signals
+        post_migrate.connect(search.create_room_search_index, sender=self)
+        post_migrate.connect(search.create_user_search_index, sender=self)
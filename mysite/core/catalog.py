@@ -0,0 +1,80 @@
+import hashlib
+import time
+
+from django.core.cache import cache, caches
+from rest_framework.renderers import JSONRenderer
+
+from core.models import Room
+from core.serializers import RoomNameSerializer
+
+CATALOG_VERSION_KEY = 'room_catalog_version'
+LEVELS_VERSION_KEY = 'room_levels_version'
+SEARCH_FIELDS_CACHE_TIMEOUT = 24 * 60 * 60
+SEARCH_FIELDS_SECTIONS = ('cities_list', 'owners_list', 'rooms_list')
+# the data of a catalog version never changes, so each process keeps it in its own memory
+local_cache = caches['local']
+
+
+def get_version(key, timeout=None):
+    """
+    a number kept in the shared cache that changes on every bump, so a change in any process reaches all of them
+    params:
+    timeout - seconds the version is kept, the data keyed by it should not be kept longer
+    """
+    version = cache.get(key)
+    if version is None:
+        # the version was evicted or expired, start from a value no older key could have used
+        cache.add(key, time.time_ns(), timeout)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(key, timeout=None):
+    # the time of the change rather than an increment, two processes bumping together still get a new version
+    cache.set(key, time.time_ns(), timeout)
+
+
+def get_catalog_version():
+    """ changes whenever a room is saved or deleted, the rating counters do not change it """
+    return get_version(CATALOG_VERSION_KEY)
+
+
+def bump_catalog_version():
+    bump_version(CATALOG_VERSION_KEY)
+
+
+def get_levels_version():
+    """ changes whenever the ratings may have moved a room to another difficulty or scariness level """
+    return get_version(LEVELS_VERSION_KEY)
+
+
+def bump_levels_version():
+    bump_version(LEVELS_VERSION_KEY)
+
+
+def get_search_fields(sections=None):
+    """
+    the search fields rendered as JSON, rendered once per catalog version
+    params:
+    sections - the SEARCH_FIELDS_SECTIONS to include, None for all of them
+    return - a dictionary with the JSON 'body', its 'etag' and its 'last_modified' time
+    """
+    if sections is None:
+        sections = SEARCH_FIELDS_SECTIONS
+    version = get_catalog_version()
+    key = 'search_fields:{}:{}'.format(version, ','.join(sections))
+    search_fields = local_cache.get(key)
+    if search_fields is None:
+        data = {}
+        if 'cities_list' in sections:
+            data['cities_list'] = list(Room.objects.all().values_list('city', flat=True).distinct())
+        if 'owners_list' in sections:
+            data['owners_list'] = list(Room.objects.all().values_list('owner', flat=True).distinct())
+        if 'rooms_list' in sections:
+            data['rooms_list'] = RoomNameSerializer(Room.objects.only('id', 'name', 'owner'), many=True).data
+        body = JSONRenderer().render(data)
+        # the same in every process, from the body and the version
+        search_fields = {'body': body, 'etag': '"{}"'.format(hashlib.md5(body).hexdigest()),
+                         'last_modified': version // 10 ** 9}
+        local_cache.set(key, search_fields, SEARCH_FIELDS_CACHE_TIMEOUT)
+    return search_fields
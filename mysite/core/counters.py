@@ -0,0 +1,210 @@
+from django.db import transaction
+from django.db.models import F, Q, Case, When, Value, FloatField, IntegerField, ExpressionWrapper, Count, Sum
+from django.db.models.functions import Cast
+
+from core.catalog import bump_levels_version
+from core.models import Room, Review, RoomRatingCount, EASY, NORMAL, HARD, NOT_SCARY, LITTLE_SCARY, VERY_SCARY, \
+    POPULARITY_PRIOR_MEAN, POPULARITY_PRIOR_COUNT, get_difficulty_level, get_scariness_level, get_popularity_score
+
+# rating name - (sum column, count column, average column)
+ROOM_RATINGS = {
+    'totalRating': ('totalRating', 'totalRating_count', 'totalRating_rank_average'),
+    'scary': ('scary_rank', 'scary_rank_count', 'scary_rank_average'),
+    'difficulty': ('difficulty_rank', 'difficulty_rank_count', 'difficulty_rank_average'),
+}
+# rating name - the values of its histogram, a scary or difficulty of 0 is a review that did not rate it
+RATING_HISTOGRAM_VALUES = {
+    'totalRating': range(1, 11),
+    'scary': range(0, 11),
+    'difficulty': range(0, 4),
+}
+# rating name - (level column, [(level, lookup, average bound)], level above the bounds), see get_difficulty_level
+ROOM_LEVELS = {
+    'difficulty': ('difficulty_level', [(EASY, 'lte', 1), (NORMAL, 'lte', 2)], HARD),
+    'scary': ('scariness_level', [(NOT_SCARY, 'lt', 4), (LITTLE_SCARY, 'lt', 7)], VERY_SCARY),
+}
+
+
+def increment(model, pk, **deltas):
+    """
+    add the deltas to the counter columns of a row in a single UPDATE, so concurrent requests do not lose updates
+    only the columns with a non zero delta are written
+    """
+    changes = {field: F(field) + delta for field, delta in deltas.items() if delta != 0}
+    if changes:
+        model.objects.filter(pk=pk).update(**changes)
+
+
+def get_average_change(sum_field, count_field, value_delta, count_delta):
+    """ the new average of a rating, computed in the UPDATE from the new sum and count """
+    new_average = ExpressionWrapper(Cast(F(sum_field) + value_delta, FloatField()) / (F(count_field) + count_delta),
+                                    output_field=FloatField())
+    return Case(When(**{count_field: -count_delta, 'then': Value(0.0)}), default=new_average,
+                output_field=FloatField())
+
+
+def get_level_change(sum_field, count_field, value_delta, count_delta, bounds, top_level):
+    """
+    the new level of a rating, computed in the UPDATE like get_difficulty_level and get_scariness_level
+    new average < bound  <=>  sum + value_delta < bound * (count + count_delta)
+    """
+    cases = [When(**{count_field: -count_delta, 'then': Value(bounds[0][0])})]
+    for level, lookup, bound in bounds:
+        limit = F(count_field) * bound + (bound * count_delta - value_delta)
+        cases.append(When(Q(**{sum_field + '__' + lookup: limit}), then=Value(level)))
+    return Case(*cases, default=Value(top_level), output_field=IntegerField())
+
+
+def get_popularity_change(value_delta, count_delta):
+    """ the new popularity score of a room, computed in the UPDATE like get_popularity_score """
+    prior_sum = POPULARITY_PRIOR_MEAN * POPULARITY_PRIOR_COUNT
+    return ExpressionWrapper(
+        Cast(F('totalRating') + (value_delta + prior_sum), FloatField()) /
+        (F('totalRating_count') + (count_delta + POPULARITY_PRIOR_COUNT)), output_field=FloatField())
+
+
+def update_room_levels(room_id, changes):
+    """
+    apply the changes to a room
+    return - (the number of updated rooms, whether the room moved to another difficulty or scariness level)
+    the UPDATE is conditioned on the new levels, so it is known without reading the room first, and a room whose
+    levels stay is still written with a single UPDATE
+    """
+    rooms = Room.objects.filter(pk=room_id)
+    levels = {level_field: changes[level_field] for level_field, bounds, top_level in ROOM_LEVELS.values()
+              if level_field in changes}
+    if not levels:
+        return rooms.update(**changes), False
+    levels_kept = Q(**levels)
+    while True:
+        if rooms.filter(levels_kept).update(**changes):
+            return 1, False
+        if rooms.exclude(levels_kept).update(**changes):
+            return 1, True
+        # a concurrent change moved the levels between the two updates, or the room was deleted
+        if not rooms.exists():
+            return 0, False
+
+
+def update_room_ratings(room_id, **deltas):
+    """
+    change the rating sums and counts of a room in a single UPDATE, the averages and levels follow them
+    a change that moves the room to another level takes a second UPDATE, see update_room_levels
+    deltas - for each changed rating of ROOM_RATINGS, a (value delta, count delta) pair
+    """
+    changes = {}
+    for rating, (value_delta, count_delta) in deltas.items():
+        if value_delta == 0 and count_delta == 0:
+            continue
+        sum_field, count_field, average_field = ROOM_RATINGS[rating]
+        changes[sum_field] = F(sum_field) + value_delta
+        changes[count_field] = F(count_field) + count_delta
+        changes[average_field] = get_average_change(sum_field, count_field, value_delta, count_delta)
+        if rating in ROOM_LEVELS:
+            level_field, bounds, top_level = ROOM_LEVELS[rating]
+            changes[level_field] = get_level_change(sum_field, count_field, value_delta, count_delta, bounds,
+                                                    top_level)
+        if rating == 'totalRating':
+            changes['popularity_score'] = get_popularity_change(value_delta, count_delta)
+    if changes and update_room_levels(room_id, changes)[1]:
+        # update() skips the Room signals, only the levels of the cached room data depend on the ratings
+        transaction.on_commit(bump_levels_version)
+
+
+def get_review_ratings_change(old_ratings, new_ratings):
+    """
+    the deltas of update_room_ratings when a review changes from the old ratings to the new ratings
+    a rating is counted only when it is above 0, like in recompute_room_ratings
+    """
+    deltas = {}
+    for rating in ROOM_RATINGS:
+        old_value, new_value = old_ratings.get(rating, 0), new_ratings.get(rating, 0)
+        deltas[rating] = (new_value - old_value, int(new_value > 0) - int(old_value > 0))
+    return deltas
+
+
+def recompute_room_ratings(room_id):
+    """
+    set the rating sums and counts of a room from all of its reviews
+    this is the repair path for counters that drifted, the views only apply deltas
+    """
+    aggregates = {}
+    for rating in ROOM_RATINGS:
+        aggregates[rating + '_sum'] = Sum(rating)
+        aggregates[rating + '_count'] = Count('pk', filter=Q(**{rating + '__gt': 0}))
+    totals = Review.objects.filter(game__room_id=room_id).aggregate(**aggregates)
+
+    changes = {}
+    averages = {}
+    for rating, (sum_field, count_field, average_field) in ROOM_RATINGS.items():
+        rating_sum, rating_count = totals[rating + '_sum'] or 0, totals[rating + '_count']
+        averages[rating] = rating_sum / rating_count if rating_count else 0
+        changes.update({sum_field: rating_sum, count_field: rating_count, average_field: averages[rating]})
+    changes['difficulty_level'] = get_difficulty_level(averages['difficulty'])
+    changes['scariness_level'] = get_scariness_level(averages['scary'])
+    changes['popularity_score'] = get_popularity_score(changes['totalRating'], changes['totalRating_count'])
+    updated, moved = update_room_levels(room_id, changes)
+    if moved:
+        transaction.on_commit(bump_levels_version)
+    return updated
+
+
+def update_rating_histogram(room_id, old_ratings=None, new_ratings=None):
+    """
+    move the review from the histogram bars of its old ratings to the bars of its new ratings
+    old_ratings is None for a new review, new_ratings is None for a deleted review
+    """
+    update_rating_histograms([(room_id, old_ratings, new_ratings)])
+
+
+def update_rating_histograms(changes):
+    """ update_rating_histogram for many (room id, old ratings, new ratings) review changes, in two queries """
+    deltas = {}
+    for room_id, old_ratings, new_ratings in changes:
+        for ratings, delta in [(old_ratings, -1), (new_ratings, 1)]:
+            for rating, value in (ratings or {}).items():
+                if rating in RATING_HISTOGRAM_VALUES:
+                    deltas[room_id, rating, value] = deltas.get((room_id, rating, value), 0) + delta
+    deltas = {bar: delta for bar, delta in deltas.items() if delta != 0}
+    if not deltas:
+        return
+    # the bars a review moves into may not exist yet, they start from 0
+    RoomRatingCount.objects.bulk_create(
+        [RoomRatingCount(room_id=room_id, rating=rating, value=value)
+         for (room_id, rating, value), delta in deltas.items() if delta > 0], ignore_conflicts=True)
+    # other bars matching the filter are left as they are by the default of the Case
+    room_ids, ratings, values = (set(column) for column in zip(*deltas))
+    bars = RoomRatingCount.objects.filter(room_id__in=room_ids, rating__in=ratings, value__in=values)
+    bars.update(count=F('count') + Case(
+        *[When(room_id=room_id, rating=rating, value=value, then=Value(delta))
+          for (room_id, rating, value), delta in deltas.items()],
+        default=Value(0), output_field=IntegerField()))
+
+
+def get_empty_histogram():
+    return {rating: {value: 0 for value in values} for rating, values in RATING_HISTOGRAM_VALUES.items()}
+
+
+def get_rating_histograms(room_ids):
+    """ the rating histograms of the rooms with a single query, room id - rating - value - count """
+    histograms = {room_id: get_empty_histogram() for room_id in room_ids}
+    bars = RoomRatingCount.objects.filter(room_id__in=histograms).values_list('room_id', 'rating', 'value', 'count')
+    for room_id, rating, value, count in bars:
+        if value in histograms[room_id].get(rating, ()):
+            histograms[room_id][rating][value] = count
+    return histograms
+
+
+def rebuild_rating_histograms(room_ids=None):
+    """ set the rating histograms from the reviews, of the given rooms or of all of them """
+    bars = RoomRatingCount.objects.all()
+    reviews = Review.objects.all()
+    if room_ids is not None:
+        bars = bars.filter(room_id__in=room_ids)
+        reviews = reviews.filter(game__room_id__in=room_ids)
+    bars.delete()
+    for rating in RATING_HISTOGRAM_VALUES:
+        counts = reviews.order_by().values_list('game__room_id', rating).annotate(count=Count('pk')).iterator()
+        RoomRatingCount.objects.bulk_create(
+            (RoomRatingCount(room_id=room_id, rating=rating, value=value, count=count)
+             for room_id, value, count in counts), batch_size=500)
@@ -0,0 +1,69 @@
+import hashlib
+from collections import Counter
+
+from django.db.models import Count
+
+from core.catalog import get_catalog_version, get_levels_version, local_cache
+from core.models import DIFFICULTY_LEVELS, SCARINESS_LEVELS
+
+FACETS_CACHE_TIMEOUT = 60 * 60
+FLAGS = ('is_kids', 'is_culinary', 'is_pregnant', 'is_deaf')
+# the query params that do not change which rooms are counted
+IGNORED_PARAMS = ('page', 'order', 'format', 'fields', 'omit', 'pagination', 'cursor', 'count')
+
+
+def get_facets_cache_key(query_params):
+    params = sorted((key, value) for key, values in query_params.lists() if key not in IGNORED_PARAMS
+                    for value in values)
+    digest = hashlib.md5(repr(params).encode('utf-8')).hexdigest()
+    return 'room_facets:{}:{}:{}'.format(get_catalog_version(), get_levels_version(), digest)
+
+
+def get_room_facets(queryset):
+    """ count the rooms per facet value with a single grouped query """
+    groups = queryset.order_by().values(
+        'city', 'owner', 'difficulty_level', 'scariness_level', 'minimal_people_amount', 'maximal_people_amount',
+        *FLAGS
+    ).annotate(count=Count('id'))
+
+    total = 0
+    cities, owners, difficulty, scariness, players = Counter(), Counter(), Counter(), Counter(), Counter()
+    flags = Counter()
+    for group in groups:
+        count = group['count']
+        total += count
+        cities[group['city']] += count
+        owners[group['owner']] += count
+        difficulty[group['difficulty_level']] += count
+        scariness[group['scariness_level']] += count
+        for flag in FLAGS:
+            if group[flag]:
+                flags[flag] += count
+        for people in range(group['minimal_people_amount'], group['maximal_people_amount'] + 1):
+            players[people] += count
+
+    facets = {
+        'count': total,
+        'cities': [{'value': city, 'count': count} for city, count in cities.most_common()],
+        'owners': [{'value': owner, 'count': count} for owner, count in owners.most_common()],
+        'difficulty': {name: difficulty[level] for level, name in DIFFICULTY_LEVELS},
+        'scariness': {name: scariness[level] for level, name in SCARINESS_LEVELS},
+        'players': {str(people): players[people] for people in sorted(players)},
+    }
+    for flag in FLAGS:
+        facets[flag] = flags[flag]
+    return facets
+
+
+def get_cached_room_facets(queryset, query_params):
+    """
+    the facets are cached per filter set until the next room write changes the catalog version, or the next rating
+    change the levels version
+    the versions are shared by the processes, the facets of the versions are kept in the memory of each one
+    """
+    key = get_facets_cache_key(query_params)
+    facets = local_cache.get(key)
+    if facets is None:
+        facets = get_room_facets(queryset)
+        local_cache.set(key, facets, FACETS_CACHE_TIMEOUT)
+    return facets
@@ -0,0 +1,133 @@
+from functools import reduce
+from math import radians, sin, cos, asin, sqrt
+from operator import or_
+
+from django.db.models import Q
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_PRECISION = 9  # a cell of about 5m x 5m
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.32
+NEAREST_START_PRECISION = 6  # a cell of about 1.2km x 0.6km
+
+
+def encode_geohash(latitude, longitude, precision=GEOHASH_PRECISION):
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    geohash = []
+    bits, bit_count, even = 0, 0, True
+    while len(geohash) < precision:
+        value, value_range = (longitude, lng_range) if even else (latitude, lat_range)
+        middle = (value_range[0] + value_range[1]) / 2
+        bits <<= 1
+        if value >= middle:
+            bits |= 1
+            value_range[0] = middle
+        else:
+            value_range[1] = middle
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(GEOHASH_ALPHABET[bits])
+            bits, bit_count = 0, 0
+    return ''.join(geohash)
+
+
+def room_geohash(latitude, longitude):
+    """ the geohash of a room, empty when the room was not geocoded yet """
+    if not latitude and not longitude:
+        return ''
+    return encode_geohash(float(latitude), float(longitude))
+
+
+def cell_size(precision):
+    """ the (height, width) of a geohash cell in degrees """
+    lng_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lng_bits
+
+
+def cell_size_km(precision, latitude):
+    """ the smaller side of a geohash cell at this latitude in km """
+    height, width = cell_size(precision)
+    return min(height * KM_PER_DEGREE, width * KM_PER_DEGREE * cos(radians(latitude)))
+
+
+def distance_km(lat1, lng1, lat2, lng2):
+    """ haversine distance """
+    lat1, lng1, lat2, lng2 = map(radians, (lat1, lng1, lat2, lng2))
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * asin(sqrt(a))
+
+
+def surrounding_cells(latitude, longitude, precision):
+    """ the geohash cell of the point and its 8 neighbours """
+    height, width = cell_size(precision)
+    cells = set()
+    for lat_step in (-1, 0, 1):
+        for lng_step in (-1, 0, 1):
+            lat = max(-90.0, min(90.0, latitude + lat_step * height))
+            lng = (longitude + lng_step * width + 180.0) % 360.0 - 180.0
+            cells.add(encode_geohash(lat, lng, precision))
+    return cells
+
+
+def precision_for_radius(radius, latitude):
+    """ the finest precision whose 3x3 cells block still covers a circle of the radius around the point """
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        if cell_size_km(precision, latitude) >= radius:
+            return precision
+    return 0
+
+
+def cells_filter(cells):
+    """ range lookups so the geohash index is used on every backend """
+    return reduce(or_, [Q(geohash__gte=cell, geohash__lt=cell + '~') for cell in cells])
+
+
+def locate(queryset, latitude, longitude, cells, read_cells=()):
+    """ (distance, id) of the rooms in the cells that are not in the read cells, only the coordinates are loaded """
+    points = queryset.filter(cells_filter(cells))
+    if read_cells:
+        points = points.exclude(cells_filter(read_cells))
+    return [(distance_km(latitude, longitude, float(lat), float(lng)), room_id)
+            for room_id, lat, lng in points.values_list('id', 'latitude', 'longitude')]
+
+
+def load_rooms(queryset, located):
+    """ the full rooms of the located (distance, id) in their order, with their distance """
+    rooms = queryset.in_bulk([room_id for distance, room_id in located])
+    for distance, room_id in located:
+        rooms[room_id].distance = distance
+    return [rooms[room_id] for distance, room_id in located]
+
+
+def rooms_within(queryset, latitude, longitude, radius):
+    cells = surrounding_cells(latitude, longitude, max(precision_for_radius(radius, latitude), 1))
+    located = sorted(point for point in locate(queryset, latitude, longitude, cells) if point[0] <= radius)
+    return load_rooms(queryset, located)
+
+
+def nearest_rooms(queryset, latitude, longitude, k, max_radius):
+    """
+    look for k rooms in the cells around the point, getting coarser until there are enough of them
+    or the cells cover max_radius, so fewer than k rooms are returned where the rooms are sparse
+    every step reads only the new cells, the k-th distance then bounds a radius search so rooms in further
+    cells are not missed
+    """
+    last_precision = max(precision_for_radius(max_radius, latitude), 1)
+    precision = max(NEAREST_START_PRECISION, last_precision)
+    cells = surrounding_cells(latitude, longitude, precision)
+    located = locate(queryset, latitude, longitude, cells)
+    while len(located) < k and precision > last_precision:
+        precision -= 1
+        new_cells = surrounding_cells(latitude, longitude, precision)
+        located += locate(queryset, latitude, longitude, new_cells, cells)
+        cells = new_cells
+    located = sorted(point for point in located if point[0] <= max_radius)
+    if len(located) >= k and located[k - 1][0] > cell_size_km(precision, latitude):
+        radius = located[k - 1][0]
+        radius_cells = surrounding_cells(latitude, longitude, max(precision_for_radius(radius, latitude), 1))
+        located += [point for point in locate(queryset, latitude, longitude, radius_cells, cells)
+                    if point[0] <= radius]
+        located.sort()
+    return load_rooms(queryset, located[:k])
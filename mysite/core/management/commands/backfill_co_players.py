@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from core.models import Game
+from core.players import backfill_co_players, BACKFILL_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Fill the co players of the games from their otherPlayers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=BACKFILL_CHUNK_SIZE,
+                            help='the number of games loaded and written at a time')
+
+    def handle(self, *args, **options):
+        games = Game.objects.all()
+        synced = backfill_co_players(games, chunk_size=options['chunk_size'])
+        self.stdout.write('synced the co players of {} games'.format(synced))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.counters import rebuild_rating_histograms
+from core.models import RoomRatingCount
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the rating histograms of the rooms from their reviews'
+
+    def add_arguments(self, parser):
+        parser.add_argument('room_ids', nargs='*', type=int, help='the rooms to rebuild, all of them by default')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            rebuild_rating_histograms(options['room_ids'] or None)
+        self.stdout.write('rebuilt {} histogram bars'.format(RoomRatingCount.objects.count()))
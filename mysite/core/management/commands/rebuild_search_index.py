@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from core.search import create_room_search_index, rebuild_room_search_index, create_user_search_index, \
+    rebuild_user_search_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full text search indexes of the rooms and the users'
+
+    def handle(self, *args, **options):
+        create_room_search_index()
+        rebuild_room_search_index()
+        self.stdout.write('the rooms search index was rebuilt')
+        create_user_search_index()
+        rebuild_user_search_index()
+        self.stdout.write('the users search index was rebuilt')
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.counters import recompute_room_ratings
+from core.models import Room
+
+
+class Command(BaseCommand):
+    help = 'Recompute the rating sums, counts and averages of the rooms from their reviews'
+
+    def add_arguments(self, parser):
+        parser.add_argument('room_ids', nargs='*', type=int, help='the rooms to recompute, all of them by default')
+
+    def handle(self, *args, **options):
+        room_ids = options['room_ids'] or Room.objects.values_list('id', flat=True).order_by('id').iterator()
+        updated = 0
+        for room_id in room_ids:
+            with transaction.atomic():
+                updated += recompute_room_ratings(room_id)
+        self.stdout.write('recomputed the ratings of {} rooms'.format(updated))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from core.geo import room_geohash
+from core.models import Room
+
+
+class Command(BaseCommand):
+    help = 'Set the geohash of every room from its latitude and longitude'
+
+    def handle(self, *args, **options):
+        updated = 0
+        for room in Room.objects.only('id', 'latitude', 'longitude', 'geohash').iterator():
+            geohash = room_geohash(room.latitude, room.longitude)
+            if geohash != room.geohash:
+                Room.objects.filter(id=room.id).update(geohash=geohash)
+                updated += 1
+        self.stdout.write('updated the geohash of {} rooms'.format(updated))
@@ -6,6 +6,38 @@ from django.db import models
 from random import random, choice
 import string
 
+# the difficulty and scariness levels the rooms are filtered by
+EASY, NORMAL, HARD = 1, 2, 3
+DIFFICULTY_LEVELS = ((EASY, 'easy'), (NORMAL, 'normal'), (HARD, 'hard'))
+NOT_SCARY, LITTLE_SCARY, VERY_SCARY = 1, 2, 3
+SCARINESS_LEVELS = ((NOT_SCARY, 'not_scary'), (LITTLE_SCARY, 'little_scary'), (VERY_SCARY, 'very_scary'))
+# the popularity score of a room is the bayesian average of its total ratings,
+# every room starts with POPULARITY_PRIOR_COUNT ratings of POPULARITY_PRIOR_MEAN
+POPULARITY_PRIOR_MEAN = 5.5
+POPULARITY_PRIOR_COUNT = 5
+
+
+def get_difficulty_level(difficulty_average):
+    if difficulty_average <= 1:
+        return EASY
+    if difficulty_average <= 2:
+        return NORMAL
+    return HARD
+
+
+def get_popularity_score(total_rating, total_rating_count):
+    """ a few high ratings do not beat many good ones, rooms without ratings are in the middle """
+    return (POPULARITY_PRIOR_MEAN * POPULARITY_PRIOR_COUNT + float(total_rating)) / \
+           (POPULARITY_PRIOR_COUNT + total_rating_count)
+
+
+def get_scariness_level(scary_average):
+    if scary_average < 4:
+        return NOT_SCARY
+    if scary_average < 7:
+        return LITTLE_SCARY
+    return VERY_SCARY
+
 
 class UserManager(BaseUserManager):
 
@@ -51,6 +83,11 @@ class User(AbstractBaseUser, PermissionsMixin):
         name = self.first_name + ' ' + self.last_name
         return name
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['searchable', 'last_name', 'first_name', 'id'], name='user_searchable_name_idx'),
+        ]
+
 
 class Room(models.Model):
     name = models.CharField(max_length=255, validators=[MinLengthValidator(2)])
@@ -70,6 +107,11 @@ class Room(models.Model):
     difficulty_rank = models.DecimalField(default=0, decimal_places=1,
                                           max_digits=10)  # Sum of all the difficulty ratings
     difficulty_rank_average = models.DecimalField(default=0, decimal_places=8, max_digits=9)
+    # Set from the averages
+    difficulty_level = models.PositiveSmallIntegerField(default=EASY, choices=DIFFICULTY_LEVELS)
+    scariness_level = models.PositiveSmallIntegerField(default=NOT_SCARY, choices=SCARINESS_LEVELS)
+    # Set from totalRating and totalRating_count, see get_popularity_score
+    popularity_score = models.FloatField(default=POPULARITY_PRIOR_MEAN)
 
     duration = models.IntegerField(default=60)
     is_kids = models.BooleanField(default=False)
@@ -81,6 +123,7 @@ class Room(models.Model):
     city = models.CharField(max_length=255)
     latitude = models.DecimalField(decimal_places=7, max_digits=14, default=0)
     longitude = models.DecimalField(decimal_places=7, max_digits=14, default=0)
+    geohash = models.CharField(max_length=12, blank=True, db_index=True)  # Set from the latitude and longitude
     pub_date = models.DateTimeField(default=timezone.now, null=True)
     room_tile_image = models.TextField()
     large_image = models.TextField()
@@ -90,6 +133,25 @@ class Room(models.Model):
 
     class Meta:
         unique_together = ('name', 'owner', 'city')
+        indexes = [
+            models.Index(fields=['totalRating_rank_average', 'id'], name='room_rating_average_idx'),
+            models.Index(fields=['difficulty_level', 'totalRating_rank_average', 'id'], name='room_difficulty_rating_idx'),
+            models.Index(fields=['difficulty_level', 'name', 'id'], name='room_difficulty_name_idx'),
+            models.Index(fields=['scariness_level', 'totalRating_rank_average', 'id'], name='room_scariness_rating_idx'),
+            models.Index(fields=['scariness_level', 'name', 'id'], name='room_scariness_name_idx'),
+            models.Index(fields=['popularity_score', 'id'], name='room_popularity_idx'),
+        ]
+
+
+class RoomRatingCount(models.Model):
+    """ one bar of the rating histogram of a room, the number of reviews that gave the rating this value """
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='rating_counts')
+    rating = models.CharField(max_length=20)  # totalRating, scary or difficulty
+    value = models.PositiveSmallIntegerField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('room', 'rating', 'value')
 
 
 class Game(models.Model):
@@ -103,6 +165,29 @@ class Game(models.Model):
         # return {'user': self.user, 'room': self.room}
         return 'user: ' + self.user.__str__() + ', room: ' + self.room.__str__()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'date', 'id'], name='game_user_date_idx'),
+            models.Index(fields=['user', 'room'], name='game_user_room_idx'),
+        ]
+
+
+class CoPlayer(models.Model):
+    """ a player of Game.otherPlayers, linked to the user when the player was given by the email of a user """
+    game = models.ForeignKey(Game, on_delete=models.CASCADE, related_name='co_players')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True, blank=True,
+                             related_name='co_player_games')
+    name = models.CharField(max_length=255)  # Normalized, see core.players.normalize_player_name
+
+    def __str__(self):
+        return self.name
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'game'], name='coplayer_user_game_idx'),
+            models.Index(fields=['name', 'game'], name='coplayer_name_game_idx'),
+        ]
+
 
 class Review(models.Model):
     game = models.ForeignKey(Game, on_delete=models.CASCADE)
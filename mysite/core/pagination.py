@@ -0,0 +1,147 @@
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+from functools import reduce
+from operator import or_
+import json
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    cursor pagination on the ordering of the view, pages cost the same however deep the client scrolls
+    the cursor holds the values of all the ordering fields of the row it starts after, so rows with the same key
+    are told apart by the tie-breaker instead of an OFFSET
+    the count of all the results is only queried when asked for with ?count=true
+    """
+    page_size = api_settings.PAGE_SIZE
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.ordering = tuple(view.get_ordering())
+        self.count = None
+        if request.query_params.get(self.count_query_param) == 'true':
+            self.count = queryset.count()
+
+        position, self.reverse = self.decode_cursor(request)
+        ordering = [self.reverse_field(field) for field in self.ordering] if self.reverse else self.ordering
+        queryset = queryset.order_by(*ordering)
+        if position is not None:
+            queryset = queryset.filter(self.get_after_filter(ordering, position))
+        # one more row tells if there is a page after this one
+        rows = list(queryset[:self.page_size + 1])
+        self.has_following = len(rows) > self.page_size
+        self.page = rows[:self.page_size]
+        if self.reverse:
+            self.page.reverse()
+        self.has_cursor = position is not None
+        return self.page
+
+    @staticmethod
+    def reverse_field(field):
+        return field[1:] if field.startswith('-') else '-' + field
+
+    @staticmethod
+    def get_after_filter(ordering, position):
+        """
+        the rows after the position in the ordering:
+        key1 > v1  or  (key1 = v1 and key2 > v2)  or ...  with < for the descending fields
+        """
+        conditions = []
+        for index, field in enumerate(ordering):
+            equal = {name.lstrip('-'): value for name, value in zip(ordering[:index], position[:index])}
+            lookup = field.lstrip('-') + ('__lt' if field.startswith('-') else '__gt')
+            conditions.append(Q(**equal, **{lookup: position[index]}))
+        return reduce(or_, conditions)
+
+    def get_position(self, row):
+        fields = [field.lstrip('-') for field in self.ordering]
+        values = [row[field] if isinstance(row, dict) else getattr(row, field) for field in fields]
+        # decimals and dates are kept as strings, the lookups convert them back
+        return [value if value is None or isinstance(value, (int, float, str)) else str(value) for value in values]
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None, False
+        try:
+            cursor = json.loads(b64decode(encoded.encode('ascii')).decode('utf-8'))
+            position, reverse = cursor['p'], bool(cursor.get('r'))
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(position, list) or len(position) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return position, reverse
+
+    def encode_cursor(self, row, reverse):
+        cursor = {'p': self.get_position(row)}
+        if reverse:
+            cursor['r'] = 1
+        encoded = b64encode(json.dumps(cursor, separators=(',', ':')).encode('utf-8')).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        has_next = self.has_cursor if self.reverse else self.has_following
+        if not has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        has_previous = self.has_following if self.reverse else self.has_cursor
+        if not has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        response = OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ])
+        if self.count is not None:
+            response['count'] = self.count
+            response.move_to_end('count', last=False)
+        return Response(response)
+
+
+class KeysetPaginationMixin:
+    """
+    lets clients opt in to keyset pagination with ?pagination=cursor, in the order given by ?order=
+    allowed_order maps the 'order' values to the db ordering, it should end with the id to make it unique
+    views with allow_unpaginated let clients turn the pagination off with ?pagination=none
+    """
+    allowed_order = {}
+    default_order = ('id',)
+    allow_unpaginated = False
+
+    def get_ordering(self):
+        order = self.request.query_params.get('order')
+        return self.allowed_order.get(order, self.default_order)
+
+    def is_keyset_paginated(self):
+        return self.request.query_params.get('pagination') == 'cursor'
+
+    def is_unpaginated(self):
+        return self.allow_unpaginated and self.request.query_params.get('pagination') == 'none'
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            if self.is_keyset_paginated():
+                self._paginator = KeysetPagination()
+            elif self.pagination_class is None or self.is_unpaginated():
+                self._paginator = None
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
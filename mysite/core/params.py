@@ -0,0 +1,34 @@
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+
+from core.models import DIFFICULTY_LEVELS, SCARINESS_LEVELS
+
+# the parsing of the query params, shared by the views of the apps
+
+
+def get_levels(param, levels):
+    return [level for level, name in levels if name in param]
+
+
+def get_difficulties(param):
+    levels = get_levels(param, DIFFICULTY_LEVELS)
+    if not levels:
+        return Q()
+    return Q(difficulty_level__in=levels)
+
+
+def get_scariness(param):
+    levels = get_levels(param, SCARINESS_LEVELS)
+    if not levels:
+        return Q()
+    return Q(scariness_level__in=levels)
+
+
+def get_float_param(query_params, name, min_value, max_value):
+    try:
+        value = float(query_params[name])
+    except (KeyError, ValueError):
+        raise ValidationError('חסר ערך תקין עבור ' + name)
+    if not min_value <= value <= max_value:
+        raise ValidationError('הערך של {} צריך להיות בין {} ל-{}'.format(name, min_value, max_value))
+    return value
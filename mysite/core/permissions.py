@@ -36,6 +36,6 @@ class UserHasPermissionOnReview(BasePermission):
         return False
 
     def has_permission(self, request, view):
-        if view.action in ['create'] and not request.user.is_authenticated:
+        if view.action in ['create', 'bulk'] and not request.user.is_authenticated:
             raise NeedLogin()
         return True
@@ -0,0 +1,98 @@
+import re
+
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import transaction
+from django.db.models import Count
+
+from core.models import CoPlayer, Game, User
+
+# the players in Game.otherPlayers are separated by commas, semicolons or new lines
+PLAYER_SEPARATORS = re.compile(r'[,;\n\r|]+')
+NAME_MAX_LENGTH = CoPlayer._meta.get_field('name').max_length
+BACKFILL_CHUNK_SIZE = 500
+
+
+def normalize_player_name(name):
+    return ' '.join(name.split()).casefold()[:NAME_MAX_LENGTH]
+
+
+def is_email(name):
+    try:
+        validate_email(name)
+    except ValidationError:
+        return False
+    return True
+
+
+def parse_other_players(other_players):
+    """ the distinct players of Game.otherPlayers, normalized, in their original order """
+    players = []
+    for name in PLAYER_SEPARATORS.split(other_players or ''):
+        name = normalize_player_name(name)
+        if name and name not in players:
+            players.append(name)
+    return players
+
+
+def get_users_by_email(names):
+    """ the ids of the users given by their email, in a single lookup on the unique email index """
+    emails = [name for name in names if is_email(name)]
+    if not emails:
+        return {}
+    users = User.objects.filter(email__in=emails).values_list('email', 'id')
+    return {email.casefold(): user_id for email, user_id in users}
+
+
+def build_co_players(games):
+    """ the CoPlayer rows of the games, the emails of all the games are resolved together """
+    players = {game.id: parse_other_players(game.otherPlayers) for game in games}
+    users = get_users_by_email({name for names in players.values() for name in names})
+    co_players = []
+    for game in games:
+        for name in players[game.id]:
+            user_id = users.get(name)
+            if user_id is not None and user_id == game.user_id:
+                continue
+            co_players.append(CoPlayer(game_id=game.id, user_id=user_id, name=name))
+    return co_players
+
+
+def sync_co_players(games):
+    """ replace the co players of the games by the players of their otherPlayers """
+    games = list(games)
+    if not games:
+        return
+    with transaction.atomic():
+        CoPlayer.objects.filter(game__in=[game.id for game in games]).delete()
+        CoPlayer.objects.bulk_create(build_co_players(games))
+
+
+def backfill_co_players(games=None, chunk_size=BACKFILL_CHUNK_SIZE):
+    """ sync the co players of all the games, streamed in chunks so the games are never all in memory """
+    if games is None:
+        games = Game.objects.all()
+    games = games.only('id', 'user_id', 'otherPlayers').order_by('id').iterator(chunk_size=chunk_size)
+    synced = 0
+    chunk = []
+    for game in games:
+        chunk.append(game)
+        if len(chunk) == chunk_size:
+            sync_co_players(chunk)
+            synced += len(chunk)
+            chunk = []
+    sync_co_players(chunk)
+    return synced + len(chunk)
+
+
+def get_teammates(user):
+    """ the users and the names the user played with, with the number of games """
+    return CoPlayer.objects.filter(game__user=user).values('user_id', 'name').annotate(
+        games_count=Count('game_id')).order_by('-games_count', 'name')
+
+
+def get_rooms_played_by(user_ids):
+    """ the ids of the rooms the users played, on their own games or as a co player """
+    own_rooms = Game.objects.filter(user__in=user_ids).values_list('room_id', flat=True)
+    co_player_rooms = CoPlayer.objects.filter(user__in=user_ids).values_list('game__room_id', flat=True)
+    return set(own_rooms) | set(co_player_rooms)
@@ -0,0 +1,195 @@
+import re
+import unicodedata
+from functools import reduce
+from operator import and_, or_
+
+from django.db import connection
+from django.db.models import Q, Value, IntegerField
+
+from core.models import Room, User
+
+SEARCH_TABLE = 'core_room_search'
+SEARCH_FIELDS = ('name', 'description', 'city', 'owner')
+# bm25 weights of the SEARCH_FIELDS, a match in the room name counts the most
+SEARCH_WEIGHTS = (10.0, 1.0, 4.0, 4.0)
+
+# geresh and gershayim inside a word (צ'יפס, צה"ל) are part of the word
+WORD_QUOTES = re.compile(r"(?<=\w)['\"׳״](?=\w)")
+WORDS = re.compile(r'\w+')
+
+# the names of the searchable users, a word prefix index and a trigram index for parts of words
+USER_SEARCH_TABLE = 'core_user_search'
+USER_TRIGRAM_TABLE = 'core_user_trigram'
+USER_SEARCH_FIELDS = ('first_name', 'last_name')
+# the user fields a save has to change for the index to change
+USER_INDEX_FIELDS = USER_SEARCH_FIELDS + ('searchable',)
+TRIGRAM_LENGTH = 3
+
+
+def is_search_index_supported():
+    return connection.vendor == 'sqlite'
+
+
+def normalize_search_text(text):
+    """ remove the niqqud and the in-word quotes so the text and the query are tokenized alike """
+    text = unicodedata.normalize('NFD', text or '')
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return WORD_QUOTES.sub('', text)
+
+
+def get_search_terms(query):
+    return WORDS.findall(normalize_search_text(query))
+
+
+def to_match_expression(terms):
+    """ every term must match, as a prefix of a word so partial words match while typing """
+    return ' '.join('"{}"*'.format(term) for term in terms)
+
+
+def create_room_search_index(**kwargs):
+    """ create the FTS5 table of the rooms, runs after migrate """
+    if not is_search_index_supported():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [SEARCH_TABLE])
+        if cursor.fetchone() is not None:
+            return
+        cursor.execute("CREATE VIRTUAL TABLE {} USING fts5({}, tokenize = 'unicode61 remove_diacritics 2')".format(
+            SEARCH_TABLE, ', '.join(SEARCH_FIELDS)))
+        cursor.execute("INSERT INTO {0} ({0}, rank) VALUES ('rank', %s)".format(SEARCH_TABLE),
+                       ['bm25({})'.format(', '.join(str(weight) for weight in SEARCH_WEIGHTS))])
+    rebuild_room_search_index()
+
+
+def rebuild_room_search_index():
+    if not is_search_index_supported():
+        return
+    rows = Room.objects.values_list('id', *SEARCH_FIELDS).order_by().iterator()
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM {}'.format(SEARCH_TABLE))
+        cursor.executemany('INSERT INTO {} (rowid, {}) VALUES (%s, {})'.format(
+            SEARCH_TABLE, ', '.join(SEARCH_FIELDS), ', '.join(['%s'] * len(SEARCH_FIELDS))),
+            ((row[0],) + tuple(normalize_search_text(value) for value in row[1:]) for row in rows))
+
+
+def index_room(room):
+    if not is_search_index_supported():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM {} WHERE rowid = %s'.format(SEARCH_TABLE), [room.id])
+        cursor.execute('INSERT INTO {} (rowid, {}) VALUES (%s, {})'.format(
+            SEARCH_TABLE, ', '.join(SEARCH_FIELDS), ', '.join(['%s'] * len(SEARCH_FIELDS))),
+            [room.id] + [normalize_search_text(getattr(room, field)) for field in SEARCH_FIELDS])
+
+
+def unindex_room(room_id):
+    if not is_search_index_supported():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM {} WHERE rowid = %s'.format(SEARCH_TABLE), [room_id])
+
+
+def search_rooms(queryset, query):
+    """
+    filter the rooms queryset to the rooms matching the query
+    the rooms are annotated with 'search_rank', lower is more relevant
+    """
+    terms = get_search_terms(query)
+    if not terms:
+        return queryset.none()
+    if not is_search_index_supported():
+        # no full text index on this backend, every term should appear in one of the fields
+        return queryset.filter(reduce(and_, [
+            reduce(or_, [Q(**{field + '__icontains': term}) for field in SEARCH_FIELDS]) for term in terms]))
+    return queryset.extra(
+        tables=[SEARCH_TABLE],
+        where=['{0}.rowid = {1}.id'.format(SEARCH_TABLE, Room._meta.db_table), SEARCH_TABLE + ' MATCH %s'],
+        params=[to_match_expression(terms)],
+        select={'search_rank': SEARCH_TABLE + '.rank'})
+
+
+def create_user_search_index(**kwargs):
+    """ create the FTS5 tables of the searchable user names, runs after migrate """
+    if not is_search_index_supported():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name IN (%s, %s)",
+                       [USER_SEARCH_TABLE, USER_TRIGRAM_TABLE])
+        if len(cursor.fetchall()) == 2:
+            return
+        for table, tokenizer in [(USER_SEARCH_TABLE, 'unicode61 remove_diacritics 2'), (USER_TRIGRAM_TABLE, 'trigram')]:
+            cursor.execute('DROP TABLE IF EXISTS {}'.format(table))
+            cursor.execute("CREATE VIRTUAL TABLE {} USING fts5({}, tokenize = '{}')".format(
+                table, ', '.join(USER_SEARCH_FIELDS), tokenizer))
+    rebuild_user_search_index()
+
+
+def get_user_search_row(user_id, values):
+    return (user_id,) + tuple(normalize_search_text(value).casefold() for value in values)
+
+
+def rebuild_user_search_index():
+    if not is_search_index_supported():
+        return
+    insert = 'INSERT INTO {} (rowid, {}) VALUES (%s, {})'
+    with connection.cursor() as cursor:
+        for table in [USER_SEARCH_TABLE, USER_TRIGRAM_TABLE]:
+            rows = User.objects.filter(searchable=True).values_list('id', *USER_SEARCH_FIELDS).order_by().iterator()
+            cursor.execute('DELETE FROM {}'.format(table))
+            cursor.executemany(insert.format(table, ', '.join(USER_SEARCH_FIELDS), ', '.join(['%s'] * 2)),
+                               (get_user_search_row(row[0], row[1:]) for row in rows))
+
+
+def index_user(user):
+    """ only the searchable users are in the index """
+    if not is_search_index_supported():
+        return
+    unindex_user(user.id)
+    if not user.searchable:
+        return
+    insert = 'INSERT INTO {} (rowid, {}) VALUES (%s, {})'
+    row = get_user_search_row(user.id, [getattr(user, field) for field in USER_SEARCH_FIELDS])
+    with connection.cursor() as cursor:
+        for table in [USER_SEARCH_TABLE, USER_TRIGRAM_TABLE]:
+            cursor.execute(insert.format(table, ', '.join(USER_SEARCH_FIELDS), ', '.join(['%s'] * 2)), row)
+
+
+def unindex_user(user_id):
+    if not is_search_index_supported():
+        return
+    with connection.cursor() as cursor:
+        for table in [USER_SEARCH_TABLE, USER_TRIGRAM_TABLE]:
+            cursor.execute('DELETE FROM {} WHERE rowid = %s'.format(table), [user_id])
+
+
+def to_column_match_expression(column_terms, prefix):
+    """ every (column, term) must match, in its column, as a word prefix or as a part of a word """
+    pattern = '{}: "{}"*' if prefix else '{}: "{}"'
+    return ' '.join(pattern.format(column, term) for column, term in column_terms)
+
+
+def search_users(queryset, **queries):
+    """
+    filter the users queryset to the users matching the queries of the USER_SEARCH_FIELDS, like first_name='...'
+    a word of a query matches the start of a word of the name, words of 3 letters and more also match inside words
+    the users are annotated with 'search_rank', 0 for word prefix matches that come first and 1 for the others
+    """
+    column_terms = [(field, term.casefold()) for field in USER_SEARCH_FIELDS
+                    for term in get_search_terms(queries.get(field))]
+    if not column_terms:
+        return queryset.annotate(search_rank=Value(0, output_field=IntegerField()))
+    if not is_search_index_supported():
+        # no full text index on this backend, every term should start a name
+        return queryset.filter(reduce(and_, [Q(**{field + '__istartswith': term}) for field, term in column_terms]))\
+            .annotate(search_rank=Value(0, output_field=IntegerField()))
+    prefix_match = 'SELECT rowid FROM {0} WHERE {0} MATCH %s'.format(USER_SEARCH_TABLE)
+    matches = [prefix_match]
+    params = [to_column_match_expression(column_terms, prefix=True)]
+    if all(len(term) >= TRIGRAM_LENGTH for column, term in column_terms):
+        matches.append('SELECT rowid FROM {0} WHERE {0} MATCH %s'.format(USER_TRIGRAM_TABLE))
+        params.append(to_column_match_expression(column_terms, prefix=False))
+    user_id = '{}.id'.format(User._meta.db_table)
+    return queryset.extra(
+        where=['{} IN ({})'.format(user_id, ' UNION '.join(matches))], params=params,
+        select={'search_rank': 'CASE WHEN {} IN ({}) THEN 0 ELSE 1 END'.format(user_id, prefix_match)},
+        select_params=params[:1])
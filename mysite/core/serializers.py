@@ -3,6 +3,11 @@ from django.contrib.auth import get_user_model, authenticate
 from rest_framework import serializers
 
 
+def get_rated_room_ids(user):
+    """ get the ids of all the rooms the user reviewed with a single query """
+    return set(Review.objects.filter(game__user=user).values_list('game__room_id', flat=True))
+
+
 class UserNameSerializer(serializers.ModelSerializer):
     class Meta:
         model = get_user_model()
@@ -40,10 +45,11 @@ class ReviewSerializer(serializers.ModelSerializer):
         return value
 
     def to_representation(self, instance):
+        # the game and its user should be loaded with the review, select_related('game__user')
         represent = super(ReviewSerializer, self).to_representation(instance)
-        game = Game.objects.get(pk=represent['game'])
-        represent['user'] = {'first_name': game.user.first_name,
-                             'last_name': game.user.last_name, 'id': game.user.id}
+        user = instance.game.user
+        represent['user'] = {'first_name': user.first_name,
+                             'last_name': user.last_name, 'id': user.id}
         return represent
 
     def update(self, instance, validated_data):
@@ -52,6 +58,8 @@ class ReviewSerializer(serializers.ModelSerializer):
 
 
 class RoomSerializer(serializers.ModelSerializer):
+    """ a 'fields' list in the context limits the output to these fields, see get_room_fields """
+
     class Meta:
         model = Room
         fields = (
@@ -61,30 +69,151 @@ class RoomSerializer(serializers.ModelSerializer):
             'totalRating_count', 'maximal_people_amount', 'pub_date', 'city', 'latitude', 'longitude')
         read_only_fields = ('id',)
 
+    def __init__(self, *args, **kwargs):
+        super(RoomSerializer, self).__init__(*args, **kwargs)
+        requested_fields = self.context.get('fields')
+        if requested_fields is not None:
+            for field_name in set(self.fields) - set(requested_fields):
+                self.fields.pop(field_name)
+
     def to_representation(self, instance):
         represent = super(RoomSerializer, self).to_representation(instance)
-        if instance.totalRating_count > 0:
-            represent['totalRating'] = round(instance.totalRating / instance.totalRating_count, 1)
-        else:
-            represent['totalRating'] = 0
-        if instance.scary_rank_count > 0:
-            represent['scary_rank'] = round(instance.scary_rank / instance.scary_rank_count, 1)
-        else:
-            represent['scary_rank'] = 0
-        if instance.difficulty_rank_count > 0:
-            represent['difficulty_rank'] = round(instance.difficulty_rank / instance.difficulty_rank_count, 1)
-        else:
-            represent['difficulty_rank'] = 0
-
+        requested_fields = self.context.get('fields')
+        if is_field_requested(requested_fields, 'totalRating'):
+            if instance.totalRating_count > 0:
+                represent['totalRating'] = round(instance.totalRating / instance.totalRating_count, 1)
+            else:
+                represent['totalRating'] = 0
+        if is_field_requested(requested_fields, 'scary_rank'):
+            if instance.scary_rank_count > 0:
+                represent['scary_rank'] = round(instance.scary_rank / instance.scary_rank_count, 1)
+            else:
+                represent['scary_rank'] = 0
+        if is_field_requested(requested_fields, 'difficulty_rank'):
+            if instance.difficulty_rank_count > 0:
+                represent['difficulty_rank'] = round(instance.difficulty_rank / instance.difficulty_rank_count, 1)
+            else:
+                represent['difficulty_rank'] = 0
+
+        if 'rating_histograms' in self.context and is_field_requested(requested_fields, 'rating_histogram'):
+            represent['rating_histogram'] = self.context['rating_histograms'][instance.id]
+
+        if not is_field_requested(requested_fields, 'already_rated'):
+            return represent
         request = self.context.get('request')
         if (request is None) or (not (hasattr(request, "user"))) or (not request.user.is_authenticated):
             represent['already_rated'] = False
+        elif 'rated_rooms' in self.context:
+            # list responses load the reviewed rooms of the user once, see get_rated_room_ids
+            represent['already_rated'] = instance.id in self.context['rated_rooms']
         else:
-            represent['already_rated'] = len(
-                Review.objects.filter(game__user=request.user, game__room__id=instance.id)) > 0
+            represent['already_rated'] = Review.objects.filter(game__user=request.user,
+                                                               game__room__id=instance.id).exists()
         return represent
 
 
+# the fields RoomSerializer adds in to_representation and the columns they are computed from
+ROOM_COMPUTED_FIELDS = {
+    'totalRating': ('totalRating', 'totalRating_count'),
+    'scary_rank': ('scary_rank', 'scary_rank_count'),
+    'difficulty_rank': ('difficulty_rank', 'difficulty_rank_count'),
+    'already_rated': (),
+    # only when the view loads the histograms into the 'rating_histograms' context, see get_rating_histograms
+    'rating_histogram': (),
+}
+
+
+def is_field_requested(requested_fields, field_name):
+    return requested_fields is None or field_name in requested_fields
+
+
+def get_requested_fields(query_params, all_fields):
+    """
+    the fields asked for with fields= (comma separated) minus the ones in omit=
+    return - the requested fields in their original order, None when all of them are needed
+    """
+    if 'fields' not in query_params and 'omit' not in query_params:
+        return None
+    requested_fields = list(all_fields)
+    if 'fields' in query_params:
+        only = query_params['fields'].split(',')
+        requested_fields = [field for field in requested_fields if field in only]
+    if 'omit' in query_params:
+        omit = query_params['omit'].split(',')
+        requested_fields = [field for field in requested_fields if field not in omit]
+    return requested_fields
+
+
+def get_room_fields(query_params):
+    return get_requested_fields(query_params, RoomSerializer.Meta.fields + tuple(ROOM_COMPUTED_FIELDS))
+
+
+def only_room_fields(queryset, requested_fields, *columns):
+    """ load only the columns of the requested room fields, and the given columns """
+    if requested_fields is None:
+        return queryset
+    columns = set(columns)
+    for field in requested_fields:
+        columns.update(ROOM_COMPUTED_FIELDS.get(field, (field,)))
+    return queryset.only('id', *columns)
+
+
+class RoomValuesSerializer:
+    """
+    read only RoomSerializer for room lists, builds the same output from .values() rows
+    the fields of RoomSerializer are built once per list instead of once per room
+    """
+
+    def __init__(self, rows, context=None):
+        self.rows = rows
+        self.context = context or {}
+
+    @staticmethod
+    def get_columns(requested_fields, *columns):
+        """ the columns to pass to .values() for the requested fields, and the given columns """
+        if requested_fields is None:
+            requested_fields = RoomSerializer.Meta.fields + tuple(ROOM_COMPUTED_FIELDS)
+        columns = set(columns)
+        columns.add('id')
+        for field in requested_fields:
+            columns.update(ROOM_COMPUTED_FIELDS.get(field, (field,)))
+        return sorted(columns)
+
+    @property
+    def data(self):
+        requested_fields = self.context.get('fields')
+        fields = [(name, field.to_representation) for name, field in
+                  RoomSerializer(context=self.context).fields.items() if not field.write_only]
+        averages = [(name,) + columns for name, columns in ROOM_COMPUTED_FIELDS.items()
+                    if columns and is_field_requested(requested_fields, name)]
+        histograms = None
+        if 'rating_histograms' in self.context and is_field_requested(requested_fields, 'rating_histogram'):
+            histograms = self.context['rating_histograms']
+        already_rated = None
+        if is_field_requested(requested_fields, 'already_rated'):
+            request = self.context.get('request')
+            if (request is None) or (not (hasattr(request, "user"))) or (not request.user.is_authenticated):
+                already_rated = set()
+            elif 'rated_rooms' in self.context:
+                already_rated = self.context['rated_rooms']
+            else:
+                already_rated = get_rated_room_ids(request.user)
+
+        data = []
+        for row in self.rows:
+            # a plain dict renders the same JSON as the OrderedDict of RoomSerializer
+            represent = {name: None if row[name] is None else to_representation(row[name])
+                         for name, to_representation in fields}
+            for name, total, count in averages:
+                represent[name] = round(row[total] / row[count], 1) if row[count] > 0 else 0
+            if histograms is not None:
+                represent['rating_histogram'] = histograms[row['id']]
+            if already_rated is not None:
+                represent['already_rated'] = row['id'] in already_rated
+            data.append(represent)
+        return data
+
+
 class GameSerializer(serializers.ModelSerializer):
     room = RoomNameSerializer(many=False, read_only=True)
 
@@ -109,8 +238,14 @@ class GameSerializer(serializers.ModelSerializer):
     def to_representation(self, instance):
         representation = super(GameSerializer, self).to_representation(instance)
         representation.pop('user', None)
+        if 'review_set' in getattr(instance, '_prefetched_objects_cache', {}):
+            # the reviews were prefetched with the games, see GameViewSet.list
+            reviews = instance.review_set.all()
+            if reviews:
+                representation['review'] = ReviewSerializer(reviews[0]).data
+            return representation
         try:
-            review = Review.objects.get(game=instance)
+            review = Review.objects.select_related('game__user').get(game=instance)
             representation['review'] = ReviewSerializer(review).data
         finally:
             return representation
@@ -0,0 +1,52 @@
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from core import search
+from core.players import sync_co_players
+from core.catalog import bump_catalog_version
+from core.geo import room_geohash
+from core.models import Room, Game, User, get_difficulty_level, get_scariness_level, get_popularity_score
+
+
+@receiver(pre_save, sender=Room)
+def set_room_geohash(sender, instance, **kwargs):
+    instance.geohash = room_geohash(instance.latitude, instance.longitude)
+
+
+@receiver(pre_save, sender=Room)
+def set_room_levels(sender, instance, **kwargs):
+    instance.difficulty_level = get_difficulty_level(instance.difficulty_rank_average)
+    instance.scariness_level = get_scariness_level(instance.scary_rank_average)
+    instance.popularity_score = get_popularity_score(instance.totalRating, instance.totalRating_count)
+
+
+@receiver(post_save, sender=Room)
+def room_saved(sender, instance, **kwargs):
+    search.index_room(instance)
+    bump_catalog_version()
+
+
+@receiver(post_delete, sender=Room)
+def room_deleted(sender, instance, **kwargs):
+    search.unindex_room(instance.id)
+    bump_catalog_version()
+
+
+@receiver(post_save, sender=Game)
+def game_saved(sender, instance, created, **kwargs):
+    # a new game without other players has no co players to replace
+    if not created or instance.otherPlayers:
+        sync_co_players([instance])
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, update_fields=None, **kwargs):
+    # a save of other fields only, like last_login on every login, leaves the index as it is
+    if update_fields is not None and not set(update_fields) & set(search.USER_INDEX_FIELDS):
+        return
+    search.index_user(instance)
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    search.unindex_user(instance.id)
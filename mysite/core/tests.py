@@ -1,9 +1,28 @@
+import os
+import threading
+
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection
 from django.db.models import Avg
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from rest_framework import status
+from rest_framework.authtoken.models import Token
 from rest_framework.test import APITestCase
 
-from .models import Room, Review, User, Game
-from .serializers import RoomSerializer, UserSerializer, GameSerializer, ReviewSerializer
+from .models import Room, Review, User, Game, CoPlayer
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory
+from rest_framework.request import Request
+
+from .catalog import bump_catalog_version, bump_levels_version, get_levels_version
+from .counters import increment, update_room_ratings, recompute_room_ratings, update_rating_histogram
+from .geo import nearest_rooms
+from .players import parse_other_players, get_teammates, get_rooms_played_by
+from .views import get_review_ratings, update_room_rate_after_update_review, update_room_rate_after_delete_review
+from .serializers import RoomSerializer, UserSerializer, GameSerializer, ReviewSerializer, RoomValuesSerializer, \
+    get_rated_room_ids
 
 
 class SystemTest(APITestCase):
@@ -24,6 +43,574 @@ class SystemTest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(Room.objects.count(), response.data['count'])
 
+    def test_get_rooms_order_by_rating(self):
+        """
+        Ensure the rooms are ordered by their rating average, ties are broken by id.
+        """
+        Room.objects.filter(id__in=[3, 5]).update(totalRating_rank_average=8)
+        Room.objects.filter(id=4).update(totalRating_rank_average=9.5)
+        url = '/api/room/?order=-totalRating'
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([4, 5, 3], [room['id'] for room in response.data['results'][:3]])
+
+        response = self.client.get('/api/room/?order=totalRating&page=2', format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        ids = [room['id'] for room in response.data['results']]
+        self.assertEqual(sorted(ids), ids)
+
+    def test_get_rooms_already_rated_query_count(self):
+        """
+        Ensure the already_rated flag costs a fixed number of queries for any page size.
+        """
+        user = User.objects.get(email='test@gmail.com')
+        for room_id in [1, 2, 150]:
+            game = Game.objects.create(room_id=room_id, user=user)
+            Review.objects.create(game=game, totalRating=7)
+        token = Token.objects.create(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+
+        # token, count, rooms and the rated rooms of the user
+        with self.assertNumQueries(4):
+            full_page = self.client.get('/api/room/', format='json')
+        with self.assertNumQueries(4):
+            last_page = self.client.get('/api/room/?page=7', format='json')
+        self.assertEqual(24, len(full_page.data['results']))
+        self.assertLess(len(last_page.data['results']), 24)
+        rated = [room['id'] for room in full_page.data['results'] + last_page.data['results'] if room['already_rated']]
+        self.assertEqual([1, 2, 150], rated)
+
+    def test_search_rooms(self):
+        """
+        Ensure the full text search ranks by relevance and follows room changes.
+        """
+        response = self.client.get('/api/room/', {'q': 'שוד המאה'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(1, response.data['results'][0]['id'])
+
+        room = Room.objects.get(id=2)
+        room.name = 'חדר הבריחה של צה"ל'
+        room.save()
+        response = self.client.get('/api/room/', {'q': 'צהל'}, format='json')
+        self.assertEqual(2, response.data['results'][0]['id'])
+
+        room.delete()
+        response = self.client.get('/api/room/', {'q': 'צהל'}, format='json')
+        self.assertNotIn(2, [room['id'] for room in response.data['results']])
+
+    def test_search_users(self):
+        """
+        Ensure the user search finds searchable users by the start or a part of their names, prefixes first.
+        """
+        for email, first_name, last_name, searchable in [('a@gmail.com', 'ישראל', 'כהן', True),
+                                                          ('b@gmail.com', 'רחל', 'ישראלי', True),
+                                                          ('c@gmail.com', 'שמואל', 'בן ישראל', True),
+                                                          ('d@gmail.com', 'ישראל', 'לוי', False)]:
+            User.objects.create_user(email=email, first_name=first_name, last_name=last_name, searchable=searchable)
+        url = '/api/user/search/'
+        response = self.client.get(url, {'last_name': 'ישרא'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(['בן ישראל', 'ישראלי'], [user['last_name'] for user in response.data['results']])
+
+        response = self.client.get(url, {'first_name': 'מואל'}, format='json')
+        self.assertEqual(['שמואל'], [user['first_name'] for user in response.data['results']])
+        response = self.client.get(url, {'first_name': 'ישר', 'last_name': 'כה'}, format='json')
+        self.assertEqual(['כהן'], [user['last_name'] for user in response.data['results']])
+
+        # word prefixes before parts of words
+        user = User.objects.get(email='a@gmail.com')
+        user.last_name = 'אבוישראל'
+        user.save()
+        response = self.client.get(url, {'last_name': 'ישראל'}, format='json')
+        self.assertEqual(['בן ישראל', 'ישראלי', 'אבוישראל'], [user['last_name'] for user in response.data['results']])
+
+        response = self.client.get(url, {'first_name': 'ישראל', 'last_name': 'לוי'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # saving other fields does not index the user again
+        user.last_name = 'כהן'
+        with self.assertNumQueries(1):
+            user.save(update_fields=['last_login'])
+        response = self.client.get(url, {'last_name': 'ישראל'}, format='json')
+        self.assertIn('אבוישראל', [user['last_name'] for user in response.data['results']])
+        user.save(update_fields=['last_name'])
+        response = self.client.get(url, {'last_name': 'כה'}, format='json')
+        self.assertEqual(['כהן'], [user['last_name'] for user in response.data['results']])
+
+    def test_nearby_rooms(self):
+        """
+        Ensure the nearby rooms are the nearest ones, with the other filters applied.
+        """
+        # a line of rooms going north from the point, about 1.1km apart
+        for room_id in range(1, 11):
+            room = Room.objects.get(id=room_id)
+            room.latitude, room.longitude = 32.0 + room_id * 0.01, 34.8
+            room.save()
+        url = '/api/room/nearby/'
+        response = self.client.get(url, {'lat': 32.0, 'lng': 34.8, 'k': 3}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([1, 2, 3], [room['id'] for room in response.data])
+        self.assertAlmostEqual(1.11, response.data[0]['distance'], places=1)
+
+        response = self.client.get(url, {'lat': 32.0, 'lng': 34.8, 'radius': 5}, format='json')
+        self.assertEqual([1, 2, 3, 4], [room['id'] for room in response.data])
+
+        response = self.client.get(url, {'lat': 32.0, 'lng': 34.8, 'k': 3, 'is_kids': False}, format='json')
+        expected = list(Room.objects.filter(id__lte=10, is_kids=False).order_by('id').values_list('id', flat=True))
+        self.assertEqual(expected[:3], [room['id'] for room in response.data])
+
+        # far from the rooms only the ones within the maximal radius are returned, without reading every room
+        response = self.client.get(url, {'lat': 31.6, 'lng': 34.8, 'k': 10}, format='json')
+        self.assertEqual([1, 2, 3, 4], [room['id'] for room in response.data])
+        with self.assertNumQueries(5):
+            rooms = nearest_rooms(Room.objects.all(), 31.6, 34.8, 10, 50)
+        self.assertEqual([1, 2, 3, 4], [room.id for room in rooms])
+
+        response = self.client.get(url, {'lat': 100, 'lng': 34.8}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_room_facets(self):
+        """
+        Ensure the facets count the filtered rooms and follow room changes.
+        """
+        url = '/api/room/facets/'
+        response = self.client.get(url, {'is_kids': True}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        kids_rooms = Room.objects.filter(is_kids=True)
+        self.assertEqual(kids_rooms.count(), response.data['count'])
+        self.assertEqual(kids_rooms.count(), response.data['is_kids'])
+        self.assertEqual(kids_rooms.count(), response.data['difficulty']['easy'])
+        self.assertEqual(kids_rooms.filter(city='תל אביב').count(),
+                         {city['value']: city['count'] for city in response.data['cities']}['תל אביב'])
+        self.assertEqual(kids_rooms.filter(minimal_people_amount__lte=4, maximal_people_amount__gte=4).count(),
+                         response.data['players']['4'])
+
+        room = kids_rooms.first()
+        room.city = 'עיר בדיקה'
+        room.scary_rank_average = 8
+        room.save()
+        response = self.client.get(url, {'is_kids': True}, format='json')
+        self.assertEqual(1, {city['value']: city['count'] for city in response.data['cities']}['עיר בדיקה'])
+        self.assertEqual(1, response.data['scariness']['very_scary'])
+
+        # the output params share the cached facets, a room change from another process reaches them
+        with self.assertNumQueries(0):
+            self.client.get(url, {'is_kids': True, 'fields': 'id', 'pagination': 'cursor', 'count': 'true'})
+        Room.objects.filter(pk=room.pk).update(is_kids=False)
+        bump_catalog_version()
+        response = self.client.get(url, {'is_kids': True}, format='json')
+        self.assertEqual(kids_rooms.count(), response.data['count'])
+
+        # the search fields do not depend on the ratings, only the changes that can move the levels refresh the facets
+        callbacks = len(connection.run_on_commit)
+        update_room_ratings(room.pk, totalRating=(8, 1))
+        self.assertEqual(callbacks, len(connection.run_on_commit))
+        update_room_ratings(room.pk, totalRating=(8, 1), scary=(0, 0), difficulty=(3, 1))
+        self.assertEqual([bump_levels_version], [func for savepoints, func in connection.run_on_commit[callbacks:]])
+
+    def test_get_rooms_cursor_pagination(self):
+        """
+        Ensure the cursor pages walk all the rooms in order, the count is only given when asked for.
+        """
+        for room in Room.objects.filter(id__lte=60):
+            room.totalRating_rank_average = room.id % 7
+            room.save()
+        response = self.client.get('/api/room/', {'pagination': 'cursor', 'count': 'true'}, format='json')
+        self.assertEqual(Room.objects.count(), response.data['count'])
+
+        response = self.client.get('/api/room/', {'pagination': 'cursor', 'order': '-totalRating'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('count', response.data)
+        ids = [room['id'] for room in response.data['results']]
+        while response.data['next']:
+            response = self.client.get(response.data['next'], format='json')
+            ids += [room['id'] for room in response.data['results']]
+        expected = Room.objects.order_by('-totalRating_rank_average', '-id').values_list('id', flat=True)
+        self.assertEqual(list(expected), ids)
+
+    def test_cursor_pagination_tied_keys(self):
+        """
+        Ensure the cursor pages walk more than 1000 rooms with the same rating, each room once.
+        """
+        Room.objects.bulk_create([Room(name='tied ' + str(i), owner='owner', city='city', minimal_people_amount=2,
+                                       maximal_people_amount=6) for i in range(1200)])
+        url = '/api/room/'
+        response = self.client.get(url, {'pagination': 'cursor', 'order': 'totalRating', 'fields': 'id'})
+        first_page = [room['id'] for room in response.data['results']]
+        ids = list(first_page)
+        pages = 1
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            ids += [room['id'] for room in response.data['results']]
+            pages += 1
+            if pages == 2:
+                previous = self.client.get(response.data['previous'])
+                self.assertEqual(first_page, [room['id'] for room in previous.data['results']])
+        expected = Room.objects.order_by('totalRating_rank_average', 'id').values_list('id', flat=True)
+        self.assertEqual(list(expected), ids)
+
+        # the deep pages filter on the cursor instead of skipping rows
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(response.request['PATH_INFO'] + '?' + response.request['QUERY_STRING'])
+        self.assertNotIn('OFFSET', queries[-1]['sql'])
+
+    def test_search_fields_conditional_get(self):
+        """
+        Ensure the search fields are served from the cache and answer 304 until a room changes.
+        """
+        url = '/api/search_fields/'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Room.objects.count(), len(response.json()['rooms_list']))
+        self.assertIn('Last-Modified', response)
+        etag = response['ETag']
+
+        # the shared catalog version is read from the cache files, not from the database
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # another worker renders the same response
+        last_modified = response['Last-Modified']
+        caches['local'].clear()
+        response = self.client.get(url)
+        self.assertEqual((etag, last_modified), (response['ETag'], response['Last-Modified']))
+
+        # a change made without the room signals, like in a command or a script, reaches the cached response
+        Room.objects.filter(id=2).update(name='שם מפקודה')
+        bump_catalog_version()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('שם מפקודה', [room['name'] for room in response.json()['rooms_list']])
+        etag = response['ETag']
+
+        room = Room.objects.get(id=1)
+        room.name = 'שם חדש'
+        room.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(etag, response['ETag'])
+        self.assertIn({'id': 1, 'name': 'שם חדש', 'owner': room.owner}, response.json()['rooms_list'])
+
+    def test_get_rooms_by_level(self):
+        """
+        Ensure the difficulty and scariness filters follow the room averages.
+        """
+        for room_id, difficulty, scary in [(1, 1, 3.99), (2, 1.5, 4), (3, 2.01, 7), (4, 3, 10)]:
+            room = Room.objects.get(id=room_id)
+            room.difficulty_rank_average = difficulty
+            room.scary_rank_average = scary
+            room.save()
+        url = '/api/room/'
+        response = self.client.get(url, {'difficulty': 'normal,hard'}, format='json')
+        self.assertEqual([2, 3, 4], [room['id'] for room in response.data['results']])
+        response = self.client.get(url, {'scariness': 'little_scary', 'difficulty': 'normal'}, format='json')
+        self.assertEqual([2], [room['id'] for room in response.data['results']])
+        response = self.client.get(url, {'scariness': 'very_scary'}, format='json')
+        self.assertEqual([3, 4], [room['id'] for room in response.data['results']])
+
+    def test_update_review_room_ratings(self):
+        """
+        Ensure editing a review applies the same room ratings as recomputing them from all the reviews.
+        """
+        user = User.objects.get(email='test@gmail.com')
+        room = Room.objects.create(name='חדר דירוג', owner='בעלים', city='עיר', minimal_people_amount=2,
+                                   maximal_people_amount=6)
+        review = Review.objects.create(game=Game.objects.create(room=room, user=user), totalRating=8, scary=0,
+                                       difficulty=3)
+        Review.objects.create(game=Game.objects.create(room=room, user=User.objects.create_user(
+            email='other@gmail.com', first_name='other', last_name='user')), totalRating=4, scary=9, difficulty=1)
+        recompute_room_ratings(room.pk)
+
+        old_ratings = get_review_ratings(review)
+        review.totalRating, review.scary, review.difficulty = 10, 8, 0
+        review.save()
+        # the room ratings, a second UPDATE as the room becomes easy, then the rating histogram bars are created if
+        # needed and moved
+        with self.assertNumQueries(4):
+            update_room_rate_after_update_review(old_ratings, review, room.pk)
+        room.refresh_from_db()
+        incremental = RoomSerializer(room).data
+
+        Room.objects.filter(pk=room.pk).update(totalRating=0, totalRating_count=0, scary_rank=0)
+        call_command('recompute_room_ratings', room.pk, stdout=open(os.devnull, 'w'))
+        room.refresh_from_db()
+        self.assertEqual(RoomSerializer(room).data, incremental)
+        self.assertEqual((room.totalRating, room.totalRating_count), (14, 2))
+        self.assertEqual((room.scary_rank, room.scary_rank_count), (17, 2))
+        self.assertEqual((room.difficulty_rank, room.difficulty_rank_count), (1, 1))
+        self.assertEqual(room.scariness_level, 3)
+
+        # a rating of 0 given on create is not counted either
+        token = Token.objects.create(user=User.objects.get(email='other@gmail.com'))
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        response = self.client.post('/api/room/2/review/', data={'totalRating': 7, 'scary': 0})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.patch('/api/room/2/review/{}/'.format(response.data['id']), data={'scary': 6},
+                                     format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        incremental = RoomSerializer(Room.objects.get(pk=2)).data
+        recompute_room_ratings(2)
+        room = Room.objects.get(pk=2)
+        self.assertEqual(RoomSerializer(room).data, incremental)
+        self.assertEqual(room.scary_rank_average, 6)
+
+    def test_room_rating_histogram(self):
+        """
+        Ensure the rating histograms follow the review changes and are shown on the room page.
+        """
+        user = User.objects.get(email='test@gmail.com')
+        reviews = []
+        for total_rating, scary in [(9, 7), (9, 0), (3, 7)]:
+            game = Game.objects.create(room_id=1, user=user)
+            reviews.append(Review.objects.create(game=game, totalRating=total_rating, scary=scary, difficulty=2))
+            update_rating_histogram(1, new_ratings=get_review_ratings(reviews[-1]))
+        old_ratings = get_review_ratings(reviews[0])
+        reviews[0].totalRating = 10
+        reviews[0].save()
+        update_room_rate_after_update_review(old_ratings, reviews[0], 1)
+        reviews[1].delete()
+        update_room_rate_after_delete_review(reviews[1], 1)
+
+        url = '/api/room/1/'
+        with self.assertNumQueries(2):
+            response = self.client.get(url, format='json')
+        histogram = response.data['rating_histogram']
+        self.assertEqual([0, 0, 1, 0, 0, 0, 0, 0, 0, 1], list(histogram['totalRating'].values()))
+        self.assertEqual({7: 2}, {value: count for value, count in histogram['scary'].items() if count})
+        self.assertEqual({0: 0, 1: 0, 2: 2, 3: 0}, histogram['difficulty'])
+
+        call_command('rebuild_rating_histograms', stdout=open(os.devnull, 'w'))
+        self.assertEqual(histogram, self.client.get(url, format='json').data['rating_histogram'])
+
+        response = self.client.get('/api/room/', format='json')
+        self.assertNotIn('rating_histogram', response.data['results'][0])
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/room/', {'fields': 'id,rating_histogram'}, format='json')
+        self.assertEqual(histogram, response.data['results'][0]['rating_histogram'])
+
+    def test_popular_rooms(self):
+        """
+        Ensure the popular rooms are ordered by their bayesian average and skip the rooms the user played.
+        """
+        # one rating of 10 is less popular than many ratings of 9
+        update_room_ratings(1, totalRating=(10, 1))
+        update_room_ratings(2, totalRating=(9 * 20, 20))
+        update_room_ratings(3, totalRating=(8 * 20, 20))
+        url = '/api/recommendation/popular'
+        response = self.client.get(url, format='json')
+        self.assertEqual([2, 3, 1], [room['id'] for room in response.data[:3]])
+
+        user = User.objects.get(email='test@gmail.com')
+        token = Token.objects.create(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        Game.objects.create(room_id=2, user=user)
+        response = self.client.get(url, format='json')
+        self.assertEqual([3, 1], [room['id'] for room in response.data[:2]])
+
+        # the user, the rooms and the rated rooms, however many games the user played
+        Game.objects.bulk_create([Game(room_id=room_id, user=user) for room_id in range(4, 100)])
+        with self.assertNumQueries(3):
+            response = self.client.get(url, format='json')
+        self.assertEqual([3, 1], [room['id'] for room in response.data[:2]])
+        self.assertTrue(all(room['id'] >= 100 for room in response.data[2:]))
+
+    def test_list_games_queries(self):
+        """
+        Ensure the games list costs the same number of queries however many games and reviews the user has.
+        """
+        user = User.objects.get(email='test@gmail.com')
+        token = Token.objects.create(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        games = [Game.objects.create(room_id=room_id, user=user, time=room_id) for room_id in range(1, 41)]
+        Review.objects.bulk_create([Review(game=game, totalRating=7, title='ביקורת') for game in games[::2]])
+
+        url = '/api/user/game/'
+        # the token, the count, the games with their rooms and users, and the reviews
+        with self.assertNumQueries(4):
+            response = self.client.get(url, {'order': 'date'}, format='json')
+        self.assertEqual(40, response.data['count'])
+        self.assertEqual(24, len(response.data['results']))
+        first_game = response.data['results'][0]
+        self.assertEqual({'id': 1, 'name': Room.objects.get(id=1).name, 'owner': Room.objects.get(id=1).owner},
+                         dict(first_game['room']))
+        self.assertEqual(GameSerializer(Game.objects.get(id=first_game['id'])).data, first_game)
+        self.assertNotIn('review', response.data['results'][1])
+
+        with self.assertNumQueries(3):
+            response = self.client.get(url, {'pagination': 'none'}, format='json')
+        self.assertEqual(40, len(response.data))
+
+    def test_bulk_games_errors(self):
+        """
+        Ensure every invalid game of a bulk request gets its own error and nothing is created.
+        """
+        user = User.objects.get(email='test@gmail.com')
+        Game.objects.create(room_id=1, user=user)
+        token = Token.objects.create(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        url = '/api/user/game/bulk/'
+        response = self.client.post(url, data={'room': 2}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        games = [{'room': 1}, {'room': 100000}, {'time': 20}, {'room': 2, 'time': 500}]
+        response = self.client.post(url, data=games, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual([403, 404, 404, 400], [result['status'] for result in response.data])
+        self.assertEqual(['הזמן צריך להיות בין 0 ל-240'], response.data[3]['errors'])
+        self.assertEqual(1, Game.objects.filter(user=user).count())
+
+    def test_bulk_games(self):
+        """
+        Ensure the valid games of a bulk request are created and counted once.
+        """
+        user = User.objects.get(email='test@gmail.com')
+        Game.objects.create(room_id=1, user=user)
+        token = Token.objects.create(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        games = [{'room': 2, 'time': 50, 'otherPlayers': 'דני'}, {'room': 1}, {'room': 3}, {'room': 2},
+                 {'room': 4, 'time': 70, 'date': '2019-05-01T20:00:00Z'}]
+        response = self.client.post('/api/user/game/bulk/', data=games, format='json')
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual([201, 403, 201, 403, 201], [result['status'] for result in response.data])
+        self.assertEqual(GameSerializer(Game.objects.get(user=user, room_id=2)).data, response.data[0]['game'])
+        self.assertEqual('דני', response.data[0]['game']['otherPlayers'])
+        self.assertEqual(2019, Game.objects.get(user=user, room_id=4).date.year)
+        user.refresh_from_db()
+        self.assertEqual((3, 120, 2), (user.rooms_count, user.average_time, user.room_time_count))
+
+    def test_bulk_reviews_errors(self):
+        """
+        Ensure every invalid review of a bulk request gets its own error and nothing is created.
+        """
+        user = User.objects.get(email='test@gmail.com')
+        Review.objects.create(game=Game.objects.create(room_id=1, user=user), totalRating=5)
+        url = '/api/user/review/bulk/'
+        response = self.client.post(url, data=[{'room': 2, 'totalRating': 5}], format='json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        token = Token.objects.create(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        reviews = [{'room': 1, 'totalRating': 8}, {'room': 100000, 'totalRating': 8}, {'room': 2},
+                   {'room': 3, 'totalRating': 8, 'difficulty': 4}]
+        response = self.client.post(url, data=reviews, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual([403, 404, 400, 400], [result['status'] for result in response.data])
+        self.assertEqual(['חובה לדרג את החדר'], response.data[2]['errors'])
+        self.assertEqual(1, Review.objects.filter(game__user=user).count())
+
+    def test_bulk_reviews(self):
+        """
+        Ensure the valid reviews of a bulk request are created and update the rooms like single reviews.
+        """
+        user = User.objects.get(email='test@gmail.com')
+        Game.objects.create(room_id=2, user=user, time=40)
+        token = Token.objects.create(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        reviews = [{'room': 1, 'totalRating': 8, 'scary': 6, 'difficulty': 2, 'title': 'כותרת'},
+                   {'room': 2, 'totalRating': 4}, {'room': 1, 'totalRating': 2}, {'room': 3, 'totalRating': 11}]
+        response = self.client.post('/api/user/review/bulk/', data=reviews, format='json')
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual([201, 201, 403, 400], [result['status'] for result in response.data])
+        review = Review.objects.get(game__user=user, game__room_id=1)
+        self.assertEqual(ReviewSerializer(review).data, response.data[0]['review'])
+        self.assertEqual(Game.objects.get(user=user, room_id=2), Review.objects.get(totalRating=4).game)
+
+        room = Room.objects.get(id=1)
+        self.assertEqual((room.totalRating, room.totalRating_count, room.scary_rank_count), (8, 1, 1))
+        self.assertEqual(room.difficulty_level, 2)
+        user.refresh_from_db()
+        self.assertEqual((user.rooms_count, user.reviews_count), (1, 2))
+
+    def test_co_players(self):
+        """
+        Ensure the co players follow the otherPlayers of the games and link the users given by email.
+        """
+        self.assertEqual(['דני כהן', 'dana@gmail.com', 'יוסי'],
+                         parse_other_players(' דני   כהן, Dana@Gmail.com;\nיוסי,דני כהן,'))
+        user = User.objects.get(email='test@gmail.com')
+        friend = User.objects.create_user(email='friend@gmail.com', first_name='friend', last_name='user')
+        game = Game.objects.create(room_id=1, user=user, otherPlayers='friend@gmail.com, רותם')
+        Game.objects.create(room_id=2, user=user, otherPlayers='רותם, test@gmail.com')
+        Game.objects.create(room_id=3, user=friend)
+        self.assertEqual([(friend.id, 'friend@gmail.com'), (None, 'רותם')],
+                         list(CoPlayer.objects.filter(game=game).order_by('name').values_list('user_id', 'name')))
+
+        with self.assertNumQueries(1):
+            teammates = list(get_teammates(user))
+        self.assertEqual([{'user_id': None, 'name': 'רותם', 'games_count': 2},
+                          {'user_id': friend.id, 'name': 'friend@gmail.com', 'games_count': 1}], teammates)
+        self.assertEqual({1, 3}, get_rooms_played_by([friend.id]))
+
+        game.otherPlayers = 'רותם'
+        game.save()
+        self.assertEqual({3}, get_rooms_played_by([friend.id]))
+        CoPlayer.objects.all().delete()
+        call_command('backfill_co_players', chunk_size=1, stdout=open(os.devnull, 'w'))
+        self.assertEqual([(None, 'רותם')] * 2, list(CoPlayer.objects.values_list('user_id', 'name')))
+
+    def test_get_rooms_sparse_fields(self):
+        """
+        Ensure fields= and omit= trim the rooms output without loading the columns lazily.
+        """
+        url = '/api/room/'
+        with self.assertNumQueries(2):
+            response = self.client.get(url, {'fields': 'id,name,totalRating', 'order': '-totalRating'}, format='json')
+        self.assertEqual(['id', 'name', 'totalRating'], list(response.data['results'][0].keys()))
+
+        response = self.client.get(url, {'omit': 'description,large_image,room_tile_image'}, format='json')
+        room = response.data['results'][0]
+        self.assertNotIn('description', room)
+        self.assertIn('already_rated', room)
+        self.assertEqual(RoomSerializer(Room.objects.get(id=room['id'])).data['address'], room['address'])
+
+        response = self.client.get('/api/search_fields/', {'fields': 'cities_list'})
+        self.assertEqual(['cities_list'], list(response.json().keys()))
+
+    def test_room_values_serializer_matches_room_serializer(self):
+        """
+        Ensure the .values() based room serializer renders the same JSON as RoomSerializer.
+        """
+        user = User.objects.get(email='test@gmail.com')
+        for room_id, ratings in [(1, [9, 8, 8]), (2, [7, 8]), (3, [1]), (4, [10, 9, 9, 9, 8, 7])]:
+            room = Room.objects.get(id=room_id)
+            room.totalRating, room.totalRating_count = sum(ratings), len(ratings)
+            room.scary_rank, room.scary_rank_count = sum(ratings) / 2, len(ratings)
+            room.difficulty_rank, room.difficulty_rank_count = 1.5, 2
+            room.latitude, room.longitude = 32.0853, 34.7818121
+            room.save()
+        Room.objects.filter(id=5).update(pub_date=None)
+        Review.objects.create(game=Game.objects.create(room_id=2, user=user), totalRating=8)
+
+        request = Request(APIRequestFactory().get('/api/room/'))
+        request.user = user
+        rooms = Room.objects.order_by('id')
+        for fields in [None, ['id', 'name', 'totalRating', 'already_rated'], ['latitude', 'pub_date']]:
+            context = {'request': request, 'fields': fields, 'rated_rooms': get_rated_room_ids(user)}
+            expected = JSONRenderer().render(RoomSerializer(rooms, many=True, context=context).data)
+            rows = rooms.values(*RoomValuesSerializer.get_columns(fields))
+            actual = JSONRenderer().render(RoomValuesSerializer(rows, context=context).data)
+            self.assertEqual(expected, actual)
+
+    def test_room_reviews_query_count(self):
+        """
+        Ensure a page of reviews costs the same number of queries for any number of reviews.
+        """
+        url = '/api/room/1/review/'
+        for reviews_count in [1, 5, 30]:
+            for i in range(Review.objects.filter(game__room_id=1).count(), reviews_count):
+                user = User.objects.create(email='reviewer{}@gmail.com'.format(i), first_name='reviewer',
+                                           last_name=str(i))
+                Review.objects.create(game=Game.objects.create(room_id=1, user=user), totalRating=i % 10 + 1)
+            # count and reviews with their games and users
+            with self.assertNumQueries(2):
+                response = self.client.get(url, format='json')
+            self.assertEqual(min(reviews_count, 24), len(response.data['results']))
+            self.assertEqual('reviewer', response.data['results'][0]['user']['first_name'])
+
     def test_room_rating(self):
         """
         Ensure the rooms rating is correct.
@@ -108,7 +695,7 @@ class SystemTest(APITestCase):
 
         user = UserSerializer(User.objects.get(email=data['email']))
         user = user.data
-        game_response = self.client.get(game_url)
+        game_response = self.client.get(game_url, {'pagination': 'none'})
         self.assertEqual(game_response.status_code, status.HTTP_200_OK)
         games = GameSerializer(Game.objects.filter(user=user_response.data['user']['id']), many=True)
         self.assertEqual(number_of_rooms, len(game_response.data))
@@ -121,7 +708,7 @@ class SystemTest(APITestCase):
 
         user = UserSerializer(User.objects.get(email=data['email']))
         user = user.data
-        game_response = self.client.get(game_url)
+        game_response = self.client.get(game_url, {'pagination': 'none'})
         self.assertEqual(game_response.status_code, status.HTTP_200_OK)
         games = GameSerializer(Game.objects.filter(user=user_response.data['user']['id']), many=True)
         self.assertEqual(0, len(game_response.data))
@@ -424,3 +1011,74 @@ class SystemTest(APITestCase):
         self.assertEqual(float(room.data['scary_rank_count']), 1)
 
         self.assertEqual(game.data['room']['id'], 1)
+
+
+class CountersStressTest(TransactionTestCase):
+    fixtures = ['roomTestData.json', ]
+    threads_count = 8
+    writes_per_thread = 50
+
+    def run_threads(self, write):
+        errors = []
+
+        def worker():
+            try:
+                for index in range(self.writes_per_thread):
+                    write(index)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(self.threads_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_concurrent_room_ratings(self):
+        """
+        Ensure concurrent rating changes of the same room are not lost.
+        """
+        room = Room.objects.create(name='חדר עומס', owner='בעלים', city='עיר', minimal_people_amount=2,
+                                   maximal_people_amount=6)
+
+        def write(index):
+            # every thread adds a rating of 9 and then updates it to 5
+            if index % 2 == 0:
+                update_room_ratings(room.pk, totalRating=(9, 1), scary=(8, 1), difficulty=(3, 1))
+            else:
+                update_room_ratings(room.pk, totalRating=(5 - 9, 0))
+
+        levels_version = get_levels_version()
+        self.run_threads(write)
+        room.refresh_from_db()
+        # the room moved to the top levels, the writes that kept its levels did not invalidate the cached facets
+        self.assertNotEqual(levels_version, get_levels_version())
+        ratings_count = self.threads_count * self.writes_per_thread // 2
+        self.assertEqual(room.totalRating_count, ratings_count)
+        self.assertEqual(room.totalRating, 5 * ratings_count)
+        self.assertEqual(room.scary_rank, 8 * ratings_count)
+        self.assertEqual(room.scary_rank_count, ratings_count)
+        self.assertAlmostEqual(float(room.totalRating_rank_average), 5)
+        self.assertAlmostEqual(float(room.difficulty_rank_average), 3)
+        self.assertEqual(room.scariness_level, 3)
+        self.assertEqual(room.difficulty_level, 3)
+
+    def test_concurrent_user_counters(self):
+        """
+        Ensure concurrent game writes of the same user are not lost.
+        """
+        user = User.objects.create_user(email='stress@gmail.com', password='test1234', first_name='stress',
+                                        last_name='test')
+
+        def write(index):
+            increment(User, user.pk, rooms_count=1, average_time=30, room_time_count=1)
+
+        self.run_threads(write)
+        user.refresh_from_db()
+        writes = self.threads_count * self.writes_per_thread
+        self.assertEqual(user.rooms_count, writes)
+        self.assertEqual(user.average_time, 30 * writes)
+        self.assertEqual(user.room_time_count, writes)
@@ -8,6 +8,7 @@ app_name = 'core'
 userRoutes = DefaultRouter()
 userRoutes.register(r'user/search', views.UserViewSet)
 userRoutes.register(r'user/game', views.GameViewSet)
+userRoutes.register(r'user/review', views.UserReviewViewSet)
 
 roomRoutes = DefaultRouter()
 roomRoutes.register('room', views.RoomViewSet)
@@ -1,17 +1,27 @@
 import os
-from functools import reduce
-from operator import or_
 
-from django.db.models import Q, Count, Sum
-from recombee_api_client.exceptions import ResponseException
+from django.db import transaction
+from django.db.models import F, Prefetch
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 from requests import HTTPError
 from social_core.backends.oauth import BaseOAuth2
 from social_core.exceptions import MissingBackend, AuthTokenError, AuthForbidden
 from social_django.utils import load_strategy, load_backend
 
 from core.models import Review, Room
+from core.counters import increment, update_room_ratings, get_review_ratings_change, ROOM_RATINGS, \
+    update_rating_histogram, update_rating_histograms, get_rating_histograms
+from core.search import search_rooms, search_users, is_search_index_supported, USER_SEARCH_FIELDS
+from core.geo import nearest_rooms, rooms_within
+from core.facets import get_cached_room_facets
+from core.catalog import get_search_fields
+from core.players import sync_co_players
+from core.params import get_difficulties, get_scariness, get_float_param
 from url_filter.integrations.drf import DjangoFilterBackend
 from rest_framework import viewsets, mixins, status, permissions, authentication, generics
+from rest_framework.decorators import action
 from rest_framework.authentication import TokenAuthentication
 from rest_framework.authtoken.models import Token
 from rest_framework.authtoken.views import ObtainAuthToken
@@ -20,59 +30,56 @@ from rest_framework.generics import CreateAPIView
 from rest_framework.permissions import IsAuthenticatedOrReadOnly
 from rest_framework.response import Response
 from core.models import User, Game
-from core.serializers import UserSerializer, AuthTokenSerializer, RoomSerializer, RoomNameSerializer
-from recommendationSystem.recombeeIntegration import RecombeeIntegrationClient
+from core.serializers import UserSerializer, AuthTokenSerializer, RoomNameSerializer, \
+    get_rated_room_ids, get_room_fields, only_room_fields, is_field_requested, get_requested_fields, \
+    RoomValuesSerializer
+from core.catalog import SEARCH_FIELDS_SECTIONS
+from recommendationSystem.outbox import RecombeeOutbox
 from . import serializers
+from .pagination import KeysetPaginationMixin
 from .permissions import UserHasPermissionOnGame, UserHasPermissionOnReview
 
 
 # ---------------- Aux functions ---------------------------------------
 
 def update_user_after_create_game(user, game_time):
-    user.rooms_count += 1
     if game_time > 0:
-        user.average_time += game_time
-        user.room_time_count += 1
-    # if not game_time == 0:
-    #     user.average_time = (user.average_time * user.room_time_count + game_time) / (user.room_time_count + 1)
-    #     user.room_time_count += 1
-    user.save()
+        increment(User, user.pk, rooms_count=1, average_time=game_time, room_time_count=1)
+    else:
+        increment(User, user.pk, rooms_count=1)
+
+
+def update_user_after_create_games(user, game_times):
+    """ update the user once for many new games """
+    timed_games = [game_time for game_time in game_times if game_time > 0]
+    increment(User, user.pk, rooms_count=len(game_times), average_time=sum(timed_games),
+              room_time_count=len(timed_games))
+
+
+def get_item_room_id(item):
+    """ the room id of an item of a bulk request, None when it is missing or not a number """
+    try:
+        return int(item['room'])
+    except (TypeError, KeyError, ValueError):
+        return None
 
 
 def update_user_after_update_game(user, new_game_time, old_game_time):
     if old_game_time == 0:
         if new_game_time > 0:
-            user.average_time += new_game_time
-            user.room_time_count += 1
-            # user.average_time = (user.average_time * user.room_time_count + new_game_time) / (
-            #         user.room_time_count + 1)
-            # user.room_time_count += 1
+            increment(User, user.pk, average_time=new_game_time, room_time_count=1)
     else:
         if new_game_time == 0:
-            user.average_time -= old_game_time
-            user.room_time_count -= 1
-            # user.average_time = (user.average_time * user.room_time_count - old_game_time.time) / (
-            #         user.room_time_count - 1)
-            # user.room_time_count -= 1
+            increment(User, user.pk, average_time=-old_game_time, room_time_count=-1)
         else:
-            user.average_time -= old_game_time
-            user.average_time += new_game_time
-            # time_difference = new_game_time - old_game_time.time
-            # user.average_time = (user.average_time * user.room_time_count + time_difference) / (
-            #     user.room_time_count)
-    user.save()
+            increment(User, user.pk, average_time=new_game_time - old_game_time)
 
 
 def update_user_after_delete_game(user, game_time):
-    user.rooms_count -= 1
     if game_time > 0:
-        user.average_time -= game_time
-        user.room_time_count -= 1
-    # if 0 < game_time < 240:
-    #     user.average_time = (user.average_time * user.room_time_count - game_time) / (user.room_time_count - 1)
-    #     user.room_time_count -= 1
-
-    user.save()
+        increment(User, user.pk, rooms_count=-1, average_time=-game_time, room_time_count=-1)
+    else:
+        increment(User, user.pk, rooms_count=-1)
 
 
 def try_get_review_of_game(game):
@@ -83,108 +90,38 @@ def try_get_review_of_game(game):
         return None
 
 
-def sort_by_average(room):
-    count = room.totalRating_count
-    total = room.totalRating
-    if count == 0:
-        return 0
-    return total / count
-
-
 def update_room_rate_after_delete_review(review, room_id):
     """ update room rating when a review was deleted """
-    try:
-        room_object = Room.objects.get(pk=room_id)
-    except Room.DoesNotExist:
-        return Response(status=status.HTTP_404_NOT_FOUND)
-
-    # Total rank
-    room_object.totalRating -= review.totalRating
-    room_object.totalRating_count -= 1
-    if room_object.totalRating_count == 0:
-        room_object.totalRating_rank_average = 0
-    else:
-        room_object.totalRating_rank_average = room_object.totalRating / room_object.totalRating_count
-    # if room_object.totalRating_count == 1:
-    #     room_object.totalRating = 0
-    # else:
-    #     room_object.totalRating = (room_object.totalRating * room_object.totalRating_count -
-    #                                review.totalRating) / (room_object.totalRating_count - 1)
-    # room_object.totalRating_count -= 1
-
-    # Scary ranking
-    if review.scary > 0:
-        room_object.scary_rank -= review.scary
-        room_object.scary_rank_count -= 1
-        if room_object.scary_rank_count == 0:
-            room_object.scary_rank_average = 0
-        else:
-            room_object.scary_rank_average = room_object.scary_rank / room_object.scary_rank_count
-    # if room_object.scary_rank_count > 0 and review.scary != 0:
-    #     if room_object.scary_rank_count == 1:
-    #         room_object.scary_rank = 0
-    #     else:
-    #         room_object.scary_rank = (room_object.scary_rank * room_object.scary_rank_count -
-    #                                   review.scary) / (room_object.scary_rank_count - 1)
-    #     room_object.scary_rank_count -= 1
-
-    # Difficulty ranking
-    if review.difficulty > 0:
-        room_object.difficulty_rank -= review.difficulty
-        room_object.difficulty_rank_count -= 1
-        if room_object.difficulty_rank_count == 0:
-            room_object.difficulty_rank_average = 0
-        else:
-            room_object.difficulty_rank_average = room_object.difficulty_rank / room_object.difficulty_rank_count
-    # if room_object.difficulty_rank_count > 0 and review.difficulty != 0:
-    #     if room_object.difficulty_rank_count == 1:
-    #         room_object.difficulty_rank = 0
-    #     else:
-    #         room_object.difficulty_rank = (room_object.difficulty_rank * room_object.difficulty_rank_count -
-    #                                        review.difficulty) / (room_object.difficulty_rank_count - 1)
-    #     room_object.difficulty_rank_count -= 1
+    old_ratings = get_review_ratings(review)
+    update_room_ratings(room_id, **get_review_ratings_change(old_ratings, {}))
+    update_rating_histogram(room_id, old_ratings=old_ratings)
 
-    room_object.save()
+
+def get_review_ratings(review):
+    return {rating: getattr(review, rating) for rating in ROOM_RATINGS}
+
+
+def update_room_rate_after_update_review(old_ratings, review, room_id):
+    """ update room ratings by the difference between the old and the new ratings of the review """
+    new_ratings = get_review_ratings(review)
+    update_room_ratings(room_id, **get_review_ratings_change(old_ratings, new_ratings))
+    update_rating_histogram(room_id, old_ratings=old_ratings, new_ratings=new_ratings)
 
 
 def update_user_reviews_count_after_create_review(user):
     """ update user reviews_count when a review was created """
-    user.reviews_count += 1
-    user.save()
+    increment(User, user.pk, reviews_count=1)
 
 
 def update_user_reviews_count_after_delete_review(user):
-    user.reviews_count -= 1
-    user.save()
-
-
-def update_room_rate_after_create_review(request, room):
-    """ update room ratings when a review was created """
-    if 'totalRating' in request.data:
-        room.totalRating += int(request.data['totalRating'])
-        room.totalRating_count += 1
-        room.totalRating_rank_average = room.totalRating / room.totalRating_count
-        # room.totalRating = (room.totalRating * room.totalRating_count +
-        #                     request.data['totalRating']) / (room.totalRating_count + 1)
-        # room.totalRating_count += 1
-
-    if 'scary' in request.data:
-        room.scary_rank += int(request.data['scary'])
-        room.scary_rank_count += 1
-        room.scary_rank_average = room.scary_rank / room.scary_rank_count
-        # room.scary_rank = (room.scary_rank * room.scary_rank_count +
-        #                    request.data['scary']) / (room.scary_rank_count + 1)
-        # room.scary_rank_count += 1
-
-    if 'difficulty' in request.data:
-        room.difficulty_rank += int(request.data['difficulty'])
-        room.difficulty_rank_count += 1
-        room.difficulty_rank_average = room.difficulty_rank / room.difficulty_rank_count
-        # room.difficulty_rank = (room.difficulty_rank * room.difficulty_rank_count +
-        #                         request.data['difficulty']) / (room.difficulty_rank_count + 1)
-        # room.difficulty_rank_count += 1
-
-    room.save()
+    increment(User, user.pk, reviews_count=-1)
+
+
+def update_room_rate_after_create_review(room, review):
+    """ update room ratings when a review was created, a rating of 0 is not counted like in recompute_room_ratings """
+    new_ratings = get_review_ratings(review)
+    update_room_ratings(room.pk, **get_review_ratings_change({}, new_ratings))
+    update_rating_histogram(room.pk, new_ratings=new_ratings)
 
 
 def dic_to_list(dic):
@@ -201,30 +138,6 @@ def dic_to_list(dic):
     return output
 
 
-def get_difficulties(param):
-    ranges = []
-    if 'easy' in param:
-        ranges.append(Q(difficulty_rank_average__range=[0, 1]))
-    if 'normal' in param:
-        ranges.append(Q(difficulty_rank_average__range=[1.00000001, 2]))
-    if 'hard' in param:
-        ranges.append(Q(difficulty_rank_average__range=[2.00000001, 3]))
-    query = reduce(or_, ranges, Q())
-    return query
-
-
-def get_scariness(param):
-    ranges = []
-    if 'not_scary' in param:
-        ranges.append(Q(scary_rank_average__range=[0, 3.99999999]))
-    if 'little_scary' in param:
-        ranges.append(Q(scary_rank_average__range=[4, 6.99999999]))
-    if 'very_scary' in param:
-        ranges.append(Q(scary_rank_average__range=[7, 10]))
-    query = reduce(or_, ranges, Q())
-    return query
-
-
 # ---------------- Views ---------------------------------------
 
 class ManageUserView(generics.RetrieveUpdateAPIView):
@@ -243,14 +156,10 @@ class CreateUserView(CreateAPIView):
     def create(self, request, *args, **kwargs):  # <- here i forgot self
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        self.perform_create(serializer)
-
-        # send room rating update to recombee
-        recombee_client = RecombeeIntegrationClient()
-        try:
-            recombee_client.send_user(serializer.data['id'])
-        except ResponseException:
-            print("user with id", serializer.data['id'], "is already exists in recombee")
+        with transaction.atomic():
+            self.perform_create(serializer)
+            # add the user to recombee
+            RecombeeOutbox().send_user(serializer.instance.id)
 
         headers = self.get_success_headers(serializer.data)
         token, created = Token.objects.get_or_create(user=serializer.instance)
@@ -271,14 +180,20 @@ class CreateTokenView(ObtainAuthToken):
 
 
 class SearchFieldsView(generics.GenericAPIView):
+    # public data, skipping authentication keeps repeated requests off the db
+    authentication_classes = ()
 
     def get(self, request):
-        cities_list = Room.objects.all().values_list('city', flat=True).distinct()
-        owners_list = Room.objects.all().values_list('owner', flat=True).distinct()
-        rooms_list = Room.objects.all()
-        romms_list = RoomNameSerializer(rooms_list, many=True)
-        search_fields = {'cities_list': cities_list, 'owners_list': owners_list, 'rooms_list': romms_list.data}
-        return Response(search_fields)
+        sections = get_requested_fields(request.query_params, SEARCH_FIELDS_SECTIONS)
+        search_fields = get_search_fields(sections)
+        not_modified = get_conditional_response(request, etag=search_fields['etag'],
+                                                last_modified=search_fields['last_modified'])
+        if not_modified is not None:
+            return not_modified
+        response = HttpResponse(search_fields['body'], content_type='application/json')
+        response['ETag'] = search_fields['etag']
+        response['Last-Modified'] = http_date(search_fields['last_modified'])
+        return response
 
 
 # ---------------- ViewSets ---------------------------------------
@@ -291,21 +206,27 @@ class UserViewSet(viewsets.ReadOnlyModelViewSet):
     lookup_fields = ['pk']
 
     def filter_queryset(self, queryset):
-        first_name = self.request.query_params.get('first_name')
-        last_name = self.request.query_params.get('last_name')
-        get_users = User.objects.filter(searchable=True)
-        if first_name:
-            get_users = get_users.filter(first_name__contains=first_name)
-        if last_name:
-            get_users = get_users.filter(last_name__contains=last_name)
-        if not get_users:
+        """ the searchable users matching first_name= and last_name=, the best matches first """
+        queries = {field: self.request.query_params.get(field) for field in USER_SEARCH_FIELDS}
+        users = search_users(User.objects.filter(searchable=True), **queries)
+        return users.order_by('search_rank', 'last_name', 'first_name', 'id')
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        # the page is already loaded, an empty first page means no user matched
+        if (page is not None and not page) or (page is None and not queryset.exists()):
             raise ValidationError('לא נמצא משתמש - אינו קיים או משתמש פרטי')
-        return get_users
+        if page is not None:
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+        serializer = self.get_serializer(queryset, many=True)
+        return Response(serializer.data)
 
 
 # DONE
 
-class RoomViewSet(viewsets.GenericViewSet, mixins.ListModelMixin, mixins.RetrieveModelMixin):
+class RoomViewSet(KeysetPaginationMixin, viewsets.GenericViewSet, mixins.ListModelMixin, mixins.RetrieveModelMixin):
     authentication_classes = {TokenAuthentication, }
     permission_classes = {IsAuthenticatedOrReadOnly, }
     queryset = Room.objects.all()
@@ -313,19 +234,46 @@ class RoomViewSet(viewsets.GenericViewSet, mixins.ListModelMixin, mixins.Retriev
     filter_backends = [DjangoFilterBackend]
     filter_fields = '__all__'
     lookup_fields = ['pk']
-    allowed_order = ['name', '-name', 'totalRating', '-totalRating']
+    # maps the allowed 'order' values to the db ordering, the id is a tie-breaker for stable pagination
+    allowed_order = {
+        'name': ('name', 'id'),
+        '-name': ('-name', '-id'),
+        'totalRating': ('totalRating_rank_average', 'id'),
+        '-totalRating': ('-totalRating_rank_average', '-id'),
+    }
+    default_nearby_rooms = 10
+    max_nearby_rooms = 100
+    max_nearby_radius = 50
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        # the ordering and the distance need their columns even when they are not part of the output
+        columns = [field.lstrip('-') for field in self.get_ordering()]
+        if self.action == 'nearby':
+            columns += ['latitude', 'longitude']
+        return only_room_fields(queryset, get_room_fields(self.request.query_params), *columns)
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['fields'] = get_room_fields(self.request.query_params)
+        if self.action in ['list', 'nearby'] and self.request.user.is_authenticated \
+                and is_field_requested(context['fields'], 'already_rated'):
+            context['rated_rooms'] = get_rated_room_ids(self.request.user)
+        return context
 
     def retrieve(self, request, *args, **kwargs):
         room = self.get_object()
-        room_serializer = self.get_serializer(room)
+        context = self.get_serializer_context()
+        if is_field_requested(context['fields'], 'rating_histogram'):
+            context['rating_histograms'] = get_rating_histograms([room.id])
+        room_serializer = self.get_serializer_class()(room, context=context)
 
         if (request.user.is_authenticated):
-            recombee_client = RecombeeIntegrationClient()
-            recombee_client.send_room_viewing(room.id, request.user.id)
+            RecombeeOutbox().send_room_viewing(room.id, request.user.id)
 
         return Response(room_serializer.data)
 
-    def list(self, request, *args, **kwargs):
+    def filter_rooms(self, request):
         queryset = self.filter_queryset(self.get_queryset())
 
         if 'difficulty' in request.query_params:
@@ -336,25 +284,69 @@ class RoomViewSet(viewsets.GenericViewSet, mixins.ListModelMixin, mixins.Retriev
             scariness_level = get_scariness(request.query_params['scariness'])
             queryset = queryset.filter(scariness_level)
 
-        if 'order' in request.query_params:
-            order = request.query_params['order']
-            if order in self.allowed_order:
-                if order == 'name' or order == '-name':
-                    queryset = queryset.order_by(order)
-                else:
-                    reverse = (order == '-totalRating')
-                    queryset = sorted(queryset, key=sort_by_average, reverse=reverse)
+        if 'q' in request.query_params:
+            queryset = search_rooms(queryset, request.query_params['q'])
 
-        page = self.paginate_queryset(queryset)
-        if page is not None:
-            serializer = self.get_serializer(page, many=True)
+        return queryset
 
-            return self.get_paginated_response(serializer.data)
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_rooms(request)
 
-        serializer = self.get_serializer(queryset, many=True)
+        order = request.query_params.get('order')
+        if order not in self.allowed_order and 'q' in request.query_params and is_search_index_supported() \
+                and not self.is_keyset_paginated():
+            # most relevant rooms first
+            queryset = queryset.order_by('search_rank', 'id')
+        else:
+            queryset = queryset.order_by(*self.get_ordering())
+
+        # the list is built from .values() rows, the order columns are needed for the keyset pagination
+        context = self.get_serializer_context()
+        ordering_columns = [field.lstrip('-') for field in self.get_ordering()]
+        rows = queryset.values(*RoomValuesSerializer.get_columns(context['fields'], *ordering_columns))
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            rows = page
+        # the histograms are part of a list only when asked for by name, fields=rating_histogram
+        if 'rating_histogram' in request.query_params.get('fields', '').split(','):
+            rows = list(rows)
+            context['rating_histograms'] = get_rating_histograms([row['id'] for row in rows])
+        serializer = RoomValuesSerializer(rows, context=context)
+        if page is not None:
+            return self.get_paginated_response(serializer.data)
 
         return Response(serializer.data)
 
+    @action(detail=False)
+    def nearby(self, request):
+        """ the k nearest rooms (k=) or the rooms within a radius in km (radius=) of a point (lat=, lng=) """
+        latitude = get_float_param(request.query_params, 'lat', -90, 90)
+        longitude = get_float_param(request.query_params, 'lng', -180, 180)
+        queryset = self.filter_rooms(request)
+
+        if 'radius' in request.query_params:
+            radius = get_float_param(request.query_params, 'radius', 0, self.max_nearby_radius)
+            rooms = rooms_within(queryset, latitude, longitude, radius)
+            if 'k' in request.query_params:
+                rooms = rooms[:int(get_float_param(request.query_params, 'k', 1, self.max_nearby_rooms))]
+        else:
+            k = self.default_nearby_rooms
+            if 'k' in request.query_params:
+                k = int(get_float_param(request.query_params, 'k', 1, self.max_nearby_rooms))
+            rooms = nearest_rooms(queryset, latitude, longitude, k, self.max_nearby_radius)
+
+        serializer = self.get_serializer(rooms, many=True)
+        data = serializer.data
+        for room, represent in zip(rooms, data):
+            represent['distance'] = round(room.distance, 2)
+        return Response(data)
+
+    @action(detail=False)
+    def facets(self, request):
+        """ the number of rooms per city, owner, level, flag and number of players for the current filters """
+        queryset = self.filter_rooms(request)
+        return Response(get_cached_room_facets(queryset, request.query_params))
+
     # def get_queryset(self):
     #     queryset = self.queryset
     #     number_of_players = self.request.query_params.get('numberOfPlayers', None)
@@ -370,12 +362,21 @@ class RoomViewSet(viewsets.GenericViewSet, mixins.ListModelMixin, mixins.Retriev
 
 
 # DONE
-class GameViewSet(viewsets.ModelViewSet):
+class GameViewSet(KeysetPaginationMixin, viewsets.ModelViewSet):
     """ related to the url: user/game """
     authentication_classes = (TokenAuthentication,)
     permission_classes = (UserHasPermissionOnGame,)
     queryset = Game.objects.all()
     serializer_class = serializers.GameSerializer
+    allowed_order = {
+        'date': ('date', 'id'),
+        '-date': ('-date', '-id'),
+        'name': ('room_name', 'id'),
+        '-name': ('-room_name', '-id'),
+    }
+    # a short games history can be loaded at once with ?pagination=none
+    allow_unpaginated = True
+    max_bulk_games = 500
 
     def create(self, request, *args, **kwargs):
         """ create new game """
@@ -400,16 +401,84 @@ class GameViewSet(viewsets.ModelViewSet):
             return Response(dic_to_list(game_serializer.errors), status=status.HTTP_400_BAD_REQUEST)
 
         # update all the relevant models and return the new game
-        game_serializer.save(user=request.user, room=game_room)
-        game_time = game_serializer.data.get('time', 0)
-        update_user_after_create_game(user=user, game_time=game_time)
-        recombee_client = RecombeeIntegrationClient()
-        recombee_client.send_room_done_by_user(game_room.id, user.id)
+        with transaction.atomic():
+            game_serializer.save(user=request.user, room=game_room)
+            game_time = game_serializer.data.get('time', 0)
+            update_user_after_create_game(user=user, game_time=game_time)
+            RecombeeOutbox().send_room_done_by_user(game_room.id, user.id)
         return Response(game_serializer.data, status=status.HTTP_201_CREATED)
 
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """
+        create many games at once, request.data is a list of {room, time, date, otherPlayers}
+        the valid games are created, the response has the result of every game in the order of the request
+        """
+        if not isinstance(request.data, list) or not request.data:
+            return Response(data=['יש לשלוח רשימת משחקים'], status=status.HTTP_400_BAD_REQUEST)
+        if len(request.data) > self.max_bulk_games:
+            return Response(data=['ניתן להוסיף עד {} משחקים בבת אחת'.format(self.max_bulk_games)],
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        user = request.user
+        room_ids = [get_item_room_id(item) for item in request.data]
+        existing_rooms = set(Room.objects.filter(id__in=room_ids).values_list('id', flat=True))
+        # the rooms the user already played, in one query
+        played_rooms = set(Game.objects.filter(user=user, room_id__in=existing_rooms).values_list('room_id', flat=True))
+
+        results = []
+        new_games = []
+        for item, room_id in zip(request.data, room_ids):
+            if room_id is None:
+                results.append({'status': status.HTTP_404_NOT_FOUND, 'errors': ['לא נמצא חדר']})
+                continue
+            if room_id not in existing_rooms:
+                results.append({'status': status.HTTP_404_NOT_FOUND, 'errors': ['חדר לא קיים']})
+                continue
+            if room_id in played_rooms:
+                results.append({'status': status.HTTP_403_FORBIDDEN, 'errors': ['החדר כבר ברשימת החדרים ששיחקת']})
+                continue
+            game_serializer = self.serializer_class(data=item)
+            if not game_serializer.is_valid():
+                results.append({'status': status.HTTP_400_BAD_REQUEST, 'errors': dic_to_list(game_serializer.errors)})
+                continue
+            played_rooms.add(room_id)
+            new_games.append(Game(user=user, room_id=room_id, **game_serializer.validated_data))
+            results.append(None)
+
+        if not new_games:
+            return Response(results, status=status.HTTP_400_BAD_REQUEST)
+
+        new_rooms = [game.room_id for game in new_games]
+        with transaction.atomic():
+            Game.objects.bulk_create(new_games)
+            update_user_after_create_games(user=user, game_times=[game.time for game in new_games])
+            RecombeeOutbox().send_rooms_done_by_user(new_rooms, user.id)
+        # bulk_create does not set the ids on every backend, the new games are loaded back with their rooms
+        games = Game.objects.filter(user=user, room_id__in=new_rooms).select_related('room').prefetch_related(
+            'review_set')
+        games = {game.room_id: game for game in games}
+        # bulk_create skips the post_save signal that fills the co players
+        sync_co_players(game for game in games.values() if game.otherPlayers)
+        for index, room_id in enumerate(room_ids):
+            if results[index] is None:
+                results[index] = {'status': status.HTTP_201_CREATED,
+                                  'game': self.serializer_class(games[room_id]).data}
+        if len(new_games) < len(results):
+            return Response(results, status=status.HTTP_207_MULTI_STATUS)
+        return Response(results, status=status.HTTP_201_CREATED)
+
     def list(self, request, *args, **kwargs):
         queryset = self.filter_queryset(self.get_queryset())
-        queryset = queryset.filter(user=request.user)
+        queryset = queryset.filter(user=request.user).annotate(room_name=F('room__name'))
+        # the room, the user and the review are loaded with the games, the review gets its game from the prefetch
+        queryset = queryset.select_related('room', 'user').prefetch_related(
+            Prefetch('review_set', queryset=Review.objects.order_by('id')))
+        queryset = queryset.order_by(*self.get_ordering())
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
         serializer = self.get_serializer(queryset, many=True)
         return Response(serializer.data)
 
@@ -433,8 +502,9 @@ class GameViewSet(viewsets.ModelViewSet):
         else:
             new_game_time = 0
         old_game_time = game.time
-        self.perform_update(game_serializer)
-        update_user_after_update_game(user=game.user, old_game_time=old_game_time, new_game_time=new_game_time)
+        with transaction.atomic():
+            self.perform_update(game_serializer)
+            update_user_after_update_game(user=game.user, old_game_time=old_game_time, new_game_time=new_game_time)
         return Response(game_serializer.data, status=status.HTTP_200_OK)
 
     def destroy(self, request, *args, **kwargs):
@@ -443,17 +513,16 @@ class GameViewSet(viewsets.ModelViewSet):
         user = game.user
         room_id = game.room.id
         user_id = user.id
-        self.perform_destroy(instance=game)
-        # destroy the review of the game if exists
-        if review is not None:
-            update_room_rate_after_delete_review(review, room_id)
-            update_user_reviews_count_after_delete_review(user=user)
-        recombee_client = RecombeeIntegrationClient()
-        try:
-            recombee_client.cancel_room_done_by_user(room_id, user_id)
-            recombee_client.cancel_room_rating_by_user(room_id, user_id)
-        except:
-            print("dont have review to delete")
+        with transaction.atomic():
+            self.perform_destroy(instance=game)
+            with RecombeeOutbox().batch() as recombee_outbox:
+                recombee_outbox.cancel_room_done_by_user(room_id, user_id)
+                # destroy the review of the game if exists
+                if review is not None:
+                    update_room_rate_after_delete_review(review, room_id)
+                    update_user_reviews_count_after_delete_review(user=user)
+                    recombee_outbox.cancel_room_rating_by_user(room_id, user_id)
+                    recombee_outbox.update_room_rating(room_id)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     def perform_destroy(self, instance):
@@ -464,12 +533,18 @@ class GameViewSet(viewsets.ModelViewSet):
 
 
 # DONE
-class ReviewViewSet(viewsets.ModelViewSet):
+class ReviewViewSet(KeysetPaginationMixin, viewsets.ModelViewSet):
     """ related to the url: room/review """
     authentication_classes = {TokenAuthentication, }
     permission_classes = {UserHasPermissionOnReview, }
     queryset = Review.objects.all()
     serializer_class = serializers.ReviewSerializer
+    allowed_order = {
+        'date': ('commentDate', 'id'),
+        '-date': ('-commentDate', '-id'),
+        'totalRating': ('totalRating', 'id'),
+        '-totalRating': ('-totalRating', '-id'),
+    }
 
     def create(self, request, room_pk):
         """ create new review """
@@ -479,36 +554,36 @@ class ReviewViewSet(viewsets.ModelViewSet):
             return Response(data=['לא נמצא חדר'], status=status.HTTP_404_NOT_FOUND)
 
         user = request.user
-        game, created = Game.objects.get_or_create(room=room, user=user)
+        with transaction.atomic():
+            game, created = Game.objects.get_or_create(room=room, user=user)
 
-        # check if a review for the game already exists
-        if Review.objects.filter(game=game).exists():
-            return Response(data=['כבר הגבת על החדר'], status=status.HTTP_403_FORBIDDEN)
+            # check if a review for the game already exists
+            if Review.objects.filter(game=game).exists():
+                return Response(data=['כבר הגבת על החדר'], status=status.HTTP_403_FORBIDDEN)
 
-        # insert the game to the data
-        data = request.data.copy()
-        data['game'] = game.pk
+            # insert the game to the data
+            data = request.data.copy()
+            data['game'] = game.pk
 
-        # validate the request.data
-        review_serializer = self.serializer_class(data=data)
-        if not review_serializer.is_valid():
-            return Response(dic_to_list(review_serializer.errors), status=status.HTTP_400_BAD_REQUEST)
-
-        # update all the relevant models and return the new review
-        review_serializer.save()
-        if created:
-            # if a new game was created we need to update the user_room_count
-            user.rooms_count += 1
-            recombee_client = RecombeeIntegrationClient()
-            recombee_client.send_room_done_by_user(room.id, user.id)
-            user.save()
-        update_room_rate_after_create_review(request=self.request, room=room)
-        update_user_reviews_count_after_create_review(user=user)
-        # send room rating update to recombee
-        recombee_client = RecombeeIntegrationClient()
-        recombee_client.send_room_rating_by_user(room.id, user.id, int(request.data['totalRating']))
-        roomSerializer = RoomSerializer(room)
-        recombee_client.update_room_rating(roomSerializer)
+            # validate the request.data
+            review_serializer = self.serializer_class(data=data)
+            if not review_serializer.is_valid():
+                transaction.set_rollback(True)
+                return Response(dic_to_list(review_serializer.errors), status=status.HTTP_400_BAD_REQUEST)
+
+            # update all the relevant models and return the new review
+            review_serializer.save()
+            if created:
+                # if a new game was created we need to update the user_room_count
+                increment(User, user.pk, rooms_count=1)
+            update_room_rate_after_create_review(room=room, review=review_serializer.instance)
+            update_user_reviews_count_after_create_review(user=user)
+            with RecombeeOutbox().batch() as recombee_outbox:
+                if created:
+                    recombee_outbox.send_room_done_by_user(room.id, user.id)
+                # send room rating update to recombee
+                recombee_outbox.send_room_rating_by_user(room.id, user.id, review_serializer.instance.totalRating)
+                recombee_outbox.update_room_rating(room.id)
         return Response(review_serializer.data, status=status.HTTP_201_CREATED)
 
     def update(self, request, *args, **kwargs):
@@ -521,14 +596,15 @@ class ReviewViewSet(viewsets.ModelViewSet):
         if not serializer.is_valid():
             return Response(dic_to_list(serializer.errors), status=status.HTTP_400_BAD_REQUEST)
 
-        # self.update_room_rate_after_update_review(request, review_before_update)
-        self.perform_update(serializer)
-        roomObject = Room.objects.get(pk=kwargs['room_pk'])
-        self.update_room_rate_after_update_review(roomObject)
-        recombee_client = RecombeeIntegrationClient()
-        recombee_client.update_room_rating_by_user(roomObject.id, review_before_update.game.user.id,
-                                                   review_before_update.totalRating)
-        recombee_client.update_room_rating(RoomSerializer(roomObject))
+        room_id = review_before_update.game.room_id
+        old_ratings = get_review_ratings(review_before_update)
+        with transaction.atomic():
+            self.perform_update(serializer)
+            update_room_rate_after_update_review(old_ratings, review_before_update, room_id)
+            with RecombeeOutbox().batch() as recombee_outbox:
+                recombee_outbox.update_room_rating_by_user(room_id, review_before_update.game.user.id,
+                                                           review_before_update.totalRating)
+                recombee_outbox.update_room_rating(room_id)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
     def destroy(self, request, *args, **kwargs):
@@ -537,58 +613,103 @@ class ReviewViewSet(viewsets.ModelViewSet):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     def perform_destroy(self, instance):
-        room_id = instance.game.room.pk
-        super().perform_destroy(instance)
-        update_room_rate_after_delete_review(review=instance, room_id=room_id)
-        update_user_reviews_count_after_delete_review(user=instance.game.user)
-        recombee_client = RecombeeIntegrationClient()
-        recombee_client.cancel_room_rating_by_user(room_id=instance.game.room.id, user_id=instance.game.user.id)
-        recombee_client.update_room_rating(RoomSerializer(instance.game.room))
+        room_id = instance.game.room_id
+        with transaction.atomic():
+            super().perform_destroy(instance)
+            update_room_rate_after_delete_review(review=instance, room_id=room_id)
+            update_user_reviews_count_after_delete_review(user=instance.game.user)
+            with RecombeeOutbox().batch() as recombee_outbox:
+                recombee_outbox.cancel_room_rating_by_user(room_id=room_id, user_id=instance.game.user.id)
+                recombee_outbox.update_room_rating(room_id)
 
     def get_queryset(self):
         """ get all the reviews of a room """
         queryset = self.queryset
-        query_set = queryset.filter(game__room=self.kwargs['room_pk'])
+        query_set = queryset.filter(game__room=self.kwargs['room_pk']).select_related('game__user')
+        query_set = query_set.order_by(*self.get_ordering())
         return query_set
 
-    def update_room_rate_after_update_review(self, roomObject):
-        ratings_counter = Review.objects.filter(game__room__id=roomObject.id).aggregate(
-            totalRating=Count('pk', filter=Q(totalRating__gt=0)),
-            difficulty=Count('pk', filter=Q(difficulty__gt=0)),
-            scary=Count('pk', filter=Q(scary__gt=0)))
-        ratings_sum = Review.objects.filter(game__room__id=roomObject.id).aggregate(Sum('totalRating'),
-                                                                                    Sum('difficulty'),
-                                                                                    Sum('scary'))
-
-        roomObject.totalRating = ratings_sum['totalRating__sum']
-        roomObject.totalRating_count = ratings_counter['totalRating']
-        if roomObject.totalRating_count == 0:
-            roomObject.totalRating_rank_average = 0
-        else:
-            roomObject.totalRating_rank_average = roomObject.totalRating / roomObject.totalRating_count
-
-        roomObject.difficulty_rank = ratings_sum['difficulty__sum']
-        roomObject.difficulty_rank_count = ratings_counter['difficulty']
-        if roomObject.difficulty_rank_count == 0:
-            roomObject.difficulty_rank_average = 0
-        else:
-            roomObject.difficulty_rank_average = roomObject.difficulty_rank / roomObject.difficulty_rank_count
 
-        roomObject.scary_rank = ratings_sum['scary__sum']
-        roomObject.scary_rank_count = ratings_counter['scary']
-        if roomObject.scary_rank_count == 0:
-            roomObject.scary_rank_average = 0
-        else:
-            roomObject.scary_rank_average = roomObject.scary_rank / roomObject.scary_rank_count
-
-        roomObject.save()
+class UserReviewViewSet(viewsets.GenericViewSet):
+    """ related to the url: user/review """
+    authentication_classes = (TokenAuthentication,)
+    permission_classes = (UserHasPermissionOnReview,)
+    queryset = Review.objects.all()
+    serializer_class = serializers.ReviewSerializer
+    max_bulk_reviews = 500
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """
+        review many rooms at once, request.data is a list of {room, totalRating, scary, difficulty, title, text}
+        the valid reviews are created, the response has the result of every review in the order of the request
+        """
+        if not isinstance(request.data, list) or not request.data:
+            return Response(data=['יש לשלוח רשימת תגובות'], status=status.HTTP_400_BAD_REQUEST)
+        if len(request.data) > self.max_bulk_reviews:
+            return Response(data=['ניתן להוסיף עד {} תגובות בבת אחת'.format(self.max_bulk_reviews)],
+                            status=status.HTTP_400_BAD_REQUEST)
 
-    # def update_room_rate_after_update_review(self, request, review_before_update):
-    #     """ update room rating when a review was updated """
-    #     review_instance = self.get_object()
-    #     update_room_rate_after_delete_review(review=review_before_update)
-    #     room = Room.objects.get(pk=review_instance.game.room.pk)
-    #     update_room_rate_after_create_review(request=request, room=room)
+        user = request.user
+        room_ids = [get_item_room_id(item) for item in request.data]
+        existing_rooms = set(Room.objects.filter(id__in=room_ids).values_list('id', flat=True))
+        # the games of the user in these rooms and the ones already reviewed, one query each
+        games = {game.room_id: game for game in Game.objects.filter(user=user, room_id__in=existing_rooms)}
+        reviewed_rooms = set(Review.objects.filter(game__in=games.values()).values_list('game__room_id', flat=True))
+
+        results = []
+        new_reviews = {}
+        for item, room_id in zip(request.data, room_ids):
+            if room_id is None or room_id not in existing_rooms:
+                results.append({'status': status.HTTP_404_NOT_FOUND, 'errors': ['לא נמצא חדר']})
+                continue
+            if room_id in reviewed_rooms:
+                results.append({'status': status.HTTP_403_FORBIDDEN, 'errors': ['כבר הגבת על החדר']})
+                continue
+            review_serializer = self.serializer_class(data=item)
+            # the game is set below, it may not exist yet
+            review_serializer.fields.pop('game')
+            if not review_serializer.is_valid():
+                results.append({'status': status.HTTP_400_BAD_REQUEST,
+                                'errors': dic_to_list(review_serializer.errors)})
+                continue
+            reviewed_rooms.add(room_id)
+            new_reviews[room_id] = Review(**review_serializer.validated_data)
+            results.append(None)
+
+        if not new_reviews:
+            return Response(results, status=status.HTTP_400_BAD_REQUEST)
+
+        new_game_rooms = [room_id for room_id in new_reviews if room_id not in games]
+        with transaction.atomic():
+            if new_game_rooms:
+                # reviewing a room adds it to the games of the user, like ReviewViewSet.create
+                Game.objects.bulk_create([Game(user=user, room_id=room_id) for room_id in new_game_rooms])
+                games.update({game.room_id: game for game in
+                              Game.objects.filter(user=user, room_id__in=new_game_rooms)})
+                update_user_after_create_games(user=user, game_times=[0] * len(new_game_rooms))
+            for room_id, review in new_reviews.items():
+                review.game = games[room_id]
+            Review.objects.bulk_create(new_reviews.values())
+            # one update of the sums for every reviewed room, the histograms are updated together
+            new_ratings = {room_id: get_review_ratings(review) for room_id, review in new_reviews.items()}
+            for room_id, ratings in new_ratings.items():
+                update_room_ratings(room_id, **get_review_ratings_change({}, ratings))
+            update_rating_histograms([(room_id, None, ratings) for room_id, ratings in new_ratings.items()])
+            increment(User, user.pk, reviews_count=len(new_reviews))
+            RecombeeOutbox().send_room_ratings_by_user(
+                user.id, new_game_rooms, {room_id: review.totalRating for room_id, review in new_reviews.items()},
+                list(new_reviews))
+
+        reviews = Review.objects.filter(game__user=user, game__room_id__in=new_reviews).select_related('game__user')
+        reviews = {review.game.room_id: review for review in reviews}
+        for index, room_id in enumerate(room_ids):
+            if results[index] is None:
+                results[index] = {'status': status.HTTP_201_CREATED,
+                                  'review': self.serializer_class(reviews[room_id]).data}
+        if len(new_reviews) < len(results):
+            return Response(results, status=status.HTTP_207_MULTI_STATUS)
+        return Response(results, status=status.HTTP_201_CREATED)
 
 
 class SocialLoginView(generics.GenericAPIView):
@@ -630,14 +751,11 @@ class SocialLoginView(generics.GenericAPIView):
             return Response(["Invalid token"], status=status.HTTP_400_BAD_REQUEST)
 
         if authenticated_user and authenticated_user.is_active:
-            token, created = Token.objects.get_or_create(user=authenticated_user)
-            if created:
-                # send room rating update to recombee
-                recombee_client = RecombeeIntegrationClient()
-                try:
-                    recombee_client.send_user(authenticated_user.id)
-                except ResponseException:
-                    print("user with id", authenticated_user.id, "is already exists in recombee")
+            with transaction.atomic():
+                token, created = Token.objects.get_or_create(user=authenticated_user)
+                if created:
+                    # add the user to recombee
+                    RecombeeOutbox().send_user(authenticated_user.id)
             user = UserSerializer(authenticated_user)
             response = {
                 "user": user.data,
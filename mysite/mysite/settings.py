@@ -138,6 +138,23 @@ DATABASES = {
     }
 }
 
+# Cache
+# the room catalog version and the version of the recommendations of each user are kept in files so every process
+# reads them without a database query - the server workers, the management commands and the scripts that change rooms,
+# a server on several hosts needs a shared cache like memcached instead
+# the data cached per version stays in the memory of each process, see core.catalog and recommendationSystem.cache
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache'),
+        'OPTIONS': {'MAX_ENTRIES': 20000},  # the users whose recommendations changed in the last CACHE_TTL
+    },
+    'local': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
 
@@ -181,3 +198,10 @@ AUTH_USER_MODEL = 'core.User'
 SOCIAL_AUTH_USER_MODEL = 'core.User'
 
 CORS_ORIGIN_ALLOW_ALL = True
+
+# Recombee
+# the http connections kept open to recombee by the client of each process, see recommendationSystem.recombeeIntegration
+
+RECOMBEE_POOL_SIZE = 10
+RECOMBEE_CONNECT_TIMEOUT = 3  # seconds
+RECOMBEE_READ_TIMEOUT = None  # seconds, None waits as long as the timeout of each request
@@ -0,0 +1,31 @@
+import os
+import django
+
+os.environ["DJANGO_SETTINGS_MODULE"] = 'mysite.settings'
+django.setup()
+
+from time import perf_counter
+from recombee_api_client.api_client import RecombeeClient
+from recombee_api_client.api_requests import AddDetailView
+from recommendationSystem.fake_recombee import FakeRecombeeServer
+from recommendationSystem.recombeeIntegration import DB_NAME, API_KEY
+
+# the time of a recombee call with a new client per call, like every view used to create, against the shared
+# pooled client, the calls go to a local fake recombee that answers at once so only the client overhead is measured
+CALLS_COUNT = 1000
+
+
+def measure(name, get_client):
+    start = perf_counter()
+    for call in range(CALLS_COUNT):
+        get_client().send(AddDetailView('user', str(call), cascade_create=True))
+    elapsed = perf_counter() - start
+    print('{}: {} calls in {:.0f}ms, {:.2f}ms per call'.format(name, CALLS_COUNT, elapsed * 1000,
+                                                               elapsed * 1000 / CALLS_COUNT))
+
+
+with FakeRecombeeServer() as server:
+    options = {'base_uri': server.address}
+    measure('client per call', lambda: RecombeeClient(DB_NAME, API_KEY, protocol='http', options=options))
+    pooled_client = server.client()
+    measure('shared pooled client', lambda: pooled_client)
@@ -0,0 +1,71 @@
+import os
+import django
+
+os.environ["DJANGO_SETTINGS_MODULE"] = 'mysite.settings'
+django.setup()
+
+from contextlib import redirect_stdout
+from io import StringIO
+from statistics import median
+from time import perf_counter
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import setup_test_environment
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from core.models import User
+from recommendationSystem.cache import recommendation_cache
+from recommendationSystem.fake_recombee import FakeRecombeeServer
+from recommendationSystem.outbox import send_events
+from recommendationSystem.recombeeIntegration import RecombeeIntegrationClient
+
+# the end to end time of the requests that use recombee, with the local fake recombee answering after each latency
+# the reviews only write outbox events, the send_recombee_events worker pays the latency for them
+LATENCIES = [0, 0.02, 0.1]  # seconds
+REQUESTS_COUNT = 20
+
+
+def get_client(email):
+    user = User.objects.create_user(email=email, password='benchmark', first_name='benchmark', last_name='user')
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=user).key)
+    return client
+
+
+def get_median_ms(request, before=None):
+    times = []
+    for request_number in range(REQUESTS_COUNT):
+        if before:
+            before()
+        start = perf_counter()
+        response = request(request_number)
+        times.append(perf_counter() - start)
+        assert response.status_code in (200, 201), response.data
+    return median(times) * 1000
+
+
+setup_test_environment()
+old_name = connection.creation.create_test_db(verbosity=0)
+try:
+    with redirect_stdout(StringIO()):
+        call_command('loaddata', 'roomTestData.json', verbosity=0)
+        clients = [get_client('user{}@benchmark.com'.format(latency)) for latency in LATENCIES]
+    for latency, client in zip(LATENCIES, clients):
+        with FakeRecombeeServer(latency=latency) as server, server.as_recombee():
+            with redirect_stdout(StringIO()):
+                RecombeeIntegrationClient().init_room_details()
+                RecombeeIntegrationClient().send_rooms_from_db_to_recombee()
+            recommendation = lambda request_number: client.get('/api/recommendation/personalized')
+            cold_ms = get_median_ms(recommendation, before=recommendation_cache.clear)
+            warm_ms = get_median_ms(recommendation)
+            review_ms = get_median_ms(lambda request_number: client.post(
+                '/api/room/{}/review/'.format(request_number + 1), data={'totalRating': 8}))
+            start = perf_counter()
+            with redirect_stdout(StringIO()):
+                events_count = send_events()
+            send_ms = (perf_counter() - start) * 1000
+            print('recombee latency {:.0f}ms: personalized {:.1f}ms (cached {:.1f}ms), review {:.1f}ms, '
+                  'worker sent {} events in {:.1f}ms'.format(latency * 1000, cold_ms, warm_ms, review_ms,
+                                                              events_count, send_ms))
+finally:
+    connection.creation.destroy_test_db(old_name, verbosity=0)
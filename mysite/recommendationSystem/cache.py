@@ -0,0 +1,86 @@
+from collections import OrderedDict
+import threading
+import time
+
+from core.catalog import get_version, bump_version
+
+# the recommendations of the users are kept in the process, the home screen is opened again and again
+# an invalidation changes the version of the user in the shared cache, so it reaches the entries of every process
+CACHE_SIZE = 10000  # users, the least recently used are evicted above it
+CACHE_TTL = 5 * 60  # seconds
+VERSION_KEY = 'recommendation_version:{}'
+
+
+class RecommendationCache:
+    """
+    user id - (recomm id, recommended room ids) of recombee, with the time to live and the size limit
+    the recomm id lets the next pages be asked from recombee with RecommendNextItems
+    """
+
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # user id - (expires, version, recomm id, room ids), least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.hit_seconds = 0.0
+
+    # the version of the recommendations of the user, shared by the processes
+    def get_version(self, user_id):
+        return get_version(VERSION_KEY.format(user_id), self.ttl)
+
+    # return - (recomm id, room ids) of the user, None when missing, expired or invalidated by any process
+    def get(self, user_id):
+        version = self.get_version(user_id)
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None or entry[0] <= time.monotonic() or entry[1] != version:
+                self.entries.pop(user_id, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[2:]
+
+    # params:
+    # extends - the room ids are the next page of the cached recommendation, it keeps its expiry time and version
+    def set(self, user_id, recomm_id, room_ids, extends=False):
+        version = self.get_version(user_id)
+        with self.lock:
+            expires = time.monotonic() + self.ttl
+            if extends and user_id in self.entries:
+                expires, version = self.entries[user_id][:2]
+            self.entries[user_id] = (expires, version, recomm_id, room_ids)
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        bump_version(VERSION_KEY.format(user_id), self.ttl)
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits, self.misses, self.hit_seconds = 0, 0, 0.0
+
+    # adding the time a request served from the cache took
+    def add_hit_time(self, seconds):
+        with self.lock:
+            self.hit_seconds += seconds
+
+    def stats(self):
+        with self.lock:
+            requests_count = self.hits + self.misses
+            return {
+                'users': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests_count if requests_count else 0,
+                'average_hit_ms': self.hit_seconds * 1000 / self.hits if self.hits else 0,
+            }
+
+
+recommendation_cache = RecommendationCache()
@@ -0,0 +1,244 @@
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from random import Random
+from threading import Lock, Thread
+from urllib.parse import urlsplit, parse_qsl, unquote
+import json
+import time
+import uuid
+
+from recommendationSystem.recombeeIntegration import DB_NAME, API_KEY, PooledRecombeeClient, set_recombee_client
+
+# a local stand-in of the recombee api with the requests the project sends, for the tests and the benchmarks
+# the data is kept in memory and the hmac signature is not checked
+
+
+class FakeRecombee:
+    """ the database of the fake recombee, and the requests it implements """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        self.users = set()
+        self.items = {}  # item id - values
+        self.item_properties = {}  # name - type
+        self.detail_views = []  # (user id, item id)
+        self.purchases = set()  # (user id, item id)
+        self.ratings = {}  # (user id, item id) - rating
+        self.recomms = {}  # recomm id - (user id, the item ids it returned)
+        self.requests = []  # (method, path) of every request, of the batch items too
+        self.failures = []  # [status code, path prefix, count left], see FakeRecombeeServer.fail
+
+    def handle(self, method, path, params):
+        """ run one request, return - (status code, json) """
+        with self.lock:
+            return self.handle_locked(method, path, params)
+
+    def handle_locked(self, method, path, params):
+        self.requests.append((method, path))
+        for failure in self.failures:
+            code, prefix, count = failure
+            if path.startswith(prefix):
+                failure[2] -= 1
+                if failure[2] == 0:
+                    self.failures.remove(failure)
+                return code, {'statusCode': code, 'message': 'injected error'}
+        parts = path.strip('/').split('/')
+        if method == 'POST' and parts == ['batch']:
+            # the batch is 200 even when its requests fail
+            return 200, [dict(zip(('code', 'json'), self.handle_locked(request['method'], request['path'],
+                                                                       request.get('params', {}))))
+                         for request in params['requests']]
+        return self.run(method, parts, params)
+
+    def run(self, method, parts, params):
+        parts = [unquote(part) for part in parts]
+        if method == 'PUT' and len(parts) == 2 and parts[0] == 'users':
+            return self.add_user(parts[1])
+        if method == 'PUT' and len(parts) == 3 and parts[:2] == ['items', 'properties']:
+            return self.add_item_property(parts[2], params.get('type'))
+        if method == 'POST' and len(parts) == 2 and parts[0] == 'items':
+            return self.set_item_values(parts[1], params)
+        if parts == ['detailviews'] and method == 'POST':
+            return self.add_interaction(params, lambda key: self.detail_views.append(key))
+        if parts == ['purchases'] and method == 'POST':
+            return self.add_interaction(params, self.purchases.add, self.purchases)
+        if parts == ['purchases'] and method == 'DELETE':
+            return self.delete_interaction(params, self.purchases.remove, self.purchases)
+        if parts == ['ratings'] and method == 'POST':
+            if not -1 <= float(params.get('rating', 2)) <= 1:
+                return 400, {'statusCode': 400, 'message': 'rating must be in [-1, 1]'}
+            return self.add_interaction(params, lambda key: self.ratings.update({key: float(params['rating'])}),
+                                        self.ratings)
+        if parts == ['ratings'] and method == 'DELETE':
+            return self.delete_interaction(params, self.ratings.pop, self.ratings)
+        if method == 'POST' and len(parts) == 4 and parts[0] == 'recomms' and parts[1] == 'users':
+            return self.recommend_items_to_user(parts[2], int(params.get('count', 10)))
+        if method == 'POST' and parts[:3] == ['recomms', 'next', 'items'] and len(parts) == 4:
+            return self.recommend_next_items(parts[3], int(params.get('count', 10)))
+        return 404, {'statusCode': 404, 'message': 'unknown request {} /{}'.format(method, '/'.join(parts))}
+
+    def add_user(self, user_id):
+        if user_id in self.users:
+            return 409, {'statusCode': 409, 'message': 'user already exists'}
+        self.users.add(user_id)
+        return 201, 'ok'
+
+    def add_item_property(self, name, property_type):
+        if name in self.item_properties:
+            return 409, {'statusCode': 409, 'message': 'property already exists'}
+        self.item_properties[name] = property_type
+        return 201, 'ok'
+
+    def set_item_values(self, item_id, params):
+        values = {name: value for name, value in params.items() if not name.startswith('!')}
+        unknown = [name for name in values if name not in self.item_properties]
+        if unknown:
+            return 400, {'statusCode': 400, 'message': 'unknown properties ' + ', '.join(unknown)}
+        if item_id not in self.items and not params.get('!cascadeCreate'):
+            return 404, {'statusCode': 404, 'message': 'item does not exist'}
+        self.items.setdefault(item_id, {}).update(values)
+        return 200, 'ok'
+
+    def get_interaction_key(self, params, cascade_create=False):
+        user_id, item_id = str(params['userId']), str(params['itemId'])
+        if cascade_create:
+            self.users.add(user_id)
+            self.items.setdefault(item_id, {})
+        if user_id not in self.users or item_id not in self.items:
+            return None
+        return user_id, item_id
+
+    def add_interaction(self, params, add, existing=()):
+        key = self.get_interaction_key(params, params.get('cascadeCreate', False))
+        if key is None:
+            return 404, {'statusCode': 404, 'message': 'user or item does not exist'}
+        if key in existing:
+            return 409, {'statusCode': 409, 'message': 'interaction already exists'}
+        add(key)
+        return 200, 'ok'
+
+    def delete_interaction(self, params, delete, existing):
+        key = self.get_interaction_key(params)
+        if key not in existing:
+            return 404, {'statusCode': 404, 'message': 'interaction does not exist'}
+        delete(key)
+        return 200, 'ok'
+
+    def get_recommendation(self, user_id, returned, count):
+        """ the best rated items the user did not interact with and were not returned yet """
+        interacted = {item_id for interaction_user_id, item_id in self.purchases | set(self.ratings)
+                      if interaction_user_id == user_id}
+        candidates = [item_id for item_id in self.items if item_id not in interacted and item_id not in returned]
+        candidates.sort(key=lambda item_id: (-float(self.items[item_id].get('totalRating', 0)), item_id))
+        return candidates[:count]
+
+    def recommend_items_to_user(self, user_id, count):
+        self.users.add(user_id)
+        item_ids = self.get_recommendation(user_id, (), count)
+        recomm_id = str(uuid.uuid4())
+        self.recomms[recomm_id] = (user_id, item_ids)
+        return 200, {'recommId': recomm_id, 'recomms': [{'id': item_id} for item_id in item_ids],
+                     'numberNextRecommsCalls': 0}
+
+    def recommend_next_items(self, recomm_id, count):
+        if recomm_id not in self.recomms:
+            return 404, {'statusCode': 404, 'message': 'recommendation does not exist'}
+        user_id, returned = self.recomms[recomm_id]
+        item_ids = self.get_recommendation(user_id, set(returned), count)
+        self.recomms[recomm_id] = (user_id, returned + item_ids)
+        return 200, {'recommId': recomm_id, 'recomms': [{'id': item_id} for item_id in item_ids],
+                     'numberNextRecommsCalls': len(returned) // count}
+
+
+class FakeRecombeeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like recombee
+    disable_nagle_algorithm = True  # the headers and the body are written apart
+
+    def answer(self):
+        fake_server = self.server.fake_server
+        url = urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        params = json.loads(body) if body else {}
+        params.update((name, value) for name, value in parse_qsl(url.query) if not name.startswith('hmac_'))
+        # the path starts with the database name
+        path = '/' + url.path.lstrip('/').partition('/')[2]
+        if fake_server.latency:
+            time.sleep(fake_server.latency)
+        if fake_server.random.random() < fake_server.error_rate:
+            code, response = 500, {'statusCode': 500, 'message': 'injected error'}
+        else:
+            code, response = fake_server.recombee.handle(self.command, path, params)
+        data = json.dumps(response).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_DELETE = answer
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeRecombeeServer:
+    """
+    the fake recombee over http on a free localhost port, from start() to stop() or as a context manager
+    params:
+    latency - seconds added to every http request, a batch is one request
+    error_rate - the part of the http requests answered with a 500 error
+    """
+
+    def __init__(self, latency=0, error_rate=0, seed=0):
+        self.recombee = FakeRecombee()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = Random(seed)
+        self.http_server = None
+
+    def start(self):
+        self.http_server = ThreadingHTTPServer(('127.0.0.1', 0), FakeRecombeeHandler)
+        self.http_server.daemon_threads = True
+        self.http_server.fake_server = self
+        Thread(target=self.http_server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def address(self):
+        return '127.0.0.1:{}'.format(self.http_server.server_port)
+
+    # answering the next requests whose path starts with the prefix with an error, the batch items too
+    # params:
+    # path - the path of the request without the database, like /ratings/
+    def fail(self, code, path='/', count=1):
+        with self.recombee.lock:
+            self.recombee.failures.append([code, path, count])
+
+    def client(self, **kwargs):
+        """ a recombee client sending to this server """
+        return PooledRecombeeClient(DB_NAME, API_KEY, protocol='http', options={'base_uri': self.address},
+                                    ensure_https=False, **kwargs)
+
+    @contextmanager
+    def as_recombee(self):
+        """ the shared recombee client of the process sends to this server in the block """
+        client = self.client()
+        replaced = set_recombee_client(client)
+        try:
+            yield self
+        finally:
+            set_recombee_client(replaced)
+            client.close()
@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from recommendationSystem.outbox import send_events, BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Send the events of the recombee outbox in batches, until stopped'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='send the due events and stop')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='the events sent in one batch')
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='the seconds to wait when there are no due events')
+
+    def handle(self, *args, **options):
+        while True:
+            sent = send_events(batch_size=options['batch_size'])
+            if sent:
+                self.stdout.write('sent {} events'.format(sent))
+            if options['once'] and sent < options['batch_size']:
+                return
+            if not sent:
+                time.sleep(options['interval'])
@@ -0,0 +1,34 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:41
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecombeeEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('add_user', 'add user'), ('detail_view', 'detail view'), ('purchase', 'purchase'), ('delete_purchase', 'delete purchase'), ('rating', 'rating'), ('delete_rating', 'delete rating'), ('room_values', 'room values')], max_length=20)),
+                ('user_id', models.IntegerField(null=True)),
+                ('room_id', models.IntegerField(null=True)),
+                ('rating', models.FloatField(null=True)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now)),
+                ('failed', models.BooleanField(default=False)),
+                ('last_error', models.TextField(blank=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='recombeeevent',
+            index=models.Index(fields=['failed', 'next_attempt', 'id'], name='recombee_event_due_idx'),
+        ),
+    ]
@@ -1,3 +1,37 @@
 from django.db import models
+from django.utils import timezone
 
-# Create your models here.
+
+class RecombeeEvent(models.Model):
+    """
+    an event waiting in the outbox to be sent to recombee, written in the transaction of the change it reports
+    see recommendationSystem.outbox
+    """
+    ADD_USER = 'add_user'
+    DETAIL_VIEW = 'detail_view'
+    PURCHASE = 'purchase'
+    DELETE_PURCHASE = 'delete_purchase'
+    RATING = 'rating'
+    DELETE_RATING = 'delete_rating'
+    ROOM_VALUES = 'room_values'
+    KINDS = ((ADD_USER, 'add user'), (DETAIL_VIEW, 'detail view'), (PURCHASE, 'purchase'),
+             (DELETE_PURCHASE, 'delete purchase'), (RATING, 'rating'), (DELETE_RATING, 'delete rating'),
+             (ROOM_VALUES, 'room values'))
+
+    kind = models.CharField(max_length=20, choices=KINDS)
+    user_id = models.IntegerField(null=True)
+    room_id = models.IntegerField(null=True)
+    rating = models.FloatField(null=True)  # The user rating from [0,10] of a RATING event
+    created = models.DateTimeField(default=timezone.now)
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    failed = models.BooleanField(default=False)  # Gave up after MAX_ATTEMPTS, kept for inspection
+    last_error = models.TextField(blank=True)
+
+    def __str__(self):
+        return '{} user: {} room: {}'.format(self.kind, self.user_id, self.room_id)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['failed', 'next_attempt', 'id'], name='recombee_event_due_idx'),
+        ]
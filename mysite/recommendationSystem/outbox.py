@@ -0,0 +1,234 @@
+from contextlib import contextmanager
+from datetime import timedelta
+from functools import partial
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from recombee_api_client.api_requests import AddUser, AddDetailView, AddPurchase, DeletePurchase, AddRating, \
+    DeleteRating, SetItemValues, Batch
+
+from core.models import Room
+from core.serializers import RoomSerializer
+from recommendationSystem.cache import recommendation_cache
+from recommendationSystem.models import RecombeeEvent
+from recommendationSystem.recombeeIntegration import get_recombee_client, is_delivered, NOT_DONE, \
+    normalize_user_rating, serialized_room_to_relevant_info_serial
+
+# the outbox of the recombee events
+# the views write the events in the transaction of their change, so an event is kept exactly when the change is,
+# and the send_recombee_events command sends them later in batches, the requests never wait for recombee
+
+BATCH_SIZE = 500
+MAX_ATTEMPTS = 8
+RETRY_DELAY = timedelta(seconds=30)  # doubled on every failed attempt
+# the events that change the recommendations of their user
+USER_ROOMS_KINDS = {RecombeeEvent.PURCHASE, RecombeeEvent.DELETE_PURCHASE, RecombeeEvent.RATING,
+                    RecombeeEvent.DELETE_RATING}
+
+
+class RecombeeOutbox:
+    """ writes the events of the RecombeeIntegrationClient methods to the outbox instead of sending them """
+    batched_events = None
+
+    # collecting the events added in the block, they are written with a single INSERT at its end
+    # a nested block joins the outer one, nothing is written when the block raises
+    @contextmanager
+    def batch(self):
+        if self.batched_events is not None:
+            yield self
+            return
+        self.batched_events = []
+        try:
+            yield self
+            events = self.batched_events
+        finally:
+            self.batched_events = None
+        if events:
+            self.write(events)
+
+    def add(self, *events):
+        if self.batched_events is not None:
+            self.batched_events.extend(events)
+        else:
+            self.write(events)
+
+    @staticmethod
+    def write(events):
+        RecombeeEvent.objects.bulk_create(events)
+        # the cached recommendations of the user are dropped, and again once the change is committed in case
+        # a concurrent request cached them from before the change
+        for user_id in {event.user_id for event in events if event.kind in USER_ROOMS_KINDS}:
+            recommendation_cache.invalidate(user_id)
+            transaction.on_commit(partial(recommendation_cache.invalidate, user_id))
+
+    # adding a user to recombee
+    # params:
+    # user_id - the id of the new user
+    def send_user(self, user_id):
+        self.add(RecombeeEvent(kind=RecombeeEvent.ADD_USER, user_id=user_id))
+
+    # adding a view of a room page by the user
+    def send_room_viewing(self, room_id, user_id):
+        self.add(RecombeeEvent(kind=RecombeeEvent.DETAIL_VIEW, user_id=user_id, room_id=room_id))
+
+    # adding a finished room, with its rating if the user rated it
+    # params:
+    # user_rating the room's rating from [0,10], omit empty if not rated
+    def send_room_done_by_user(self, room_id, user_id, user_rating=NOT_DONE):
+        events = [RecombeeEvent(kind=RecombeeEvent.PURCHASE, user_id=user_id, room_id=room_id)]
+        if user_rating != NOT_DONE:
+            events.append(RecombeeEvent(kind=RecombeeEvent.RATING, user_id=user_id, room_id=room_id,
+                                        rating=user_rating))
+        self.add(*events)
+
+    # adding all the rooms finished by the user
+    def send_rooms_done_by_user(self, room_ids, user_id):
+        self.add(*[RecombeeEvent(kind=RecombeeEvent.PURCHASE, user_id=user_id, room_id=room_id)
+                   for room_id in room_ids])
+
+    # adding the rating the user gave a room
+    # params:
+    # user_rating the room's rating from [0,10]
+    def send_room_rating_by_user(self, room_id, user_id, user_rating):
+        self.add(RecombeeEvent(kind=RecombeeEvent.RATING, user_id=user_id, room_id=room_id, rating=user_rating))
+
+    # adding many room ratings of the user
+    # params:
+    # done_room_ids - the rooms the user finished with these ratings
+    # user_ratings - room id - the user's rating from [0,10]
+    # room_ids - the rooms whose values changed
+    def send_room_ratings_by_user(self, user_id, done_room_ids, user_ratings, room_ids):
+        events = [RecombeeEvent(kind=RecombeeEvent.PURCHASE, user_id=user_id, room_id=room_id)
+                  for room_id in done_room_ids]
+        events += [RecombeeEvent(kind=RecombeeEvent.RATING, user_id=user_id, room_id=room_id, rating=user_rating)
+                   for room_id, user_rating in user_ratings.items()]
+        events += [RecombeeEvent(kind=RecombeeEvent.ROOM_VALUES, room_id=room_id) for room_id in room_ids]
+        self.add(*events)
+
+    def cancel_room_done_by_user(self, room_id, user_id):
+        self.add(RecombeeEvent(kind=RecombeeEvent.DELETE_PURCHASE, user_id=user_id, room_id=room_id))
+
+    def cancel_room_rating_by_user(self, room_id, user_id):
+        self.add(RecombeeEvent(kind=RecombeeEvent.DELETE_RATING, user_id=user_id, room_id=room_id))
+
+    # replacing the rating the user gave a room
+    def update_room_rating_by_user(self, room_id, user_id, user_rating):
+        self.add(RecombeeEvent(kind=RecombeeEvent.DELETE_RATING, user_id=user_id, room_id=room_id),
+                 RecombeeEvent(kind=RecombeeEvent.RATING, user_id=user_id, room_id=room_id, rating=user_rating))
+
+    # updating the values of a room after its ratings changed, the values are read when the event is sent
+    def update_room_rating(self, room_id):
+        self.add(RecombeeEvent(kind=RecombeeEvent.ROOM_VALUES, room_id=room_id))
+
+
+def get_event_key(event):
+    """
+    the events with the same key are about the same thing, only their final state has to be sent
+    a detail view is an interaction and not a state, every view is sent with its own time
+    """
+    if event.kind == RecombeeEvent.ADD_USER:
+        return 'user', event.user_id
+    if event.kind == RecombeeEvent.ROOM_VALUES:
+        return 'room', event.room_id
+    if event.kind in (RecombeeEvent.PURCHASE, RecombeeEvent.DELETE_PURCHASE):
+        return 'purchase', event.user_id, event.room_id
+    if event.kind in (RecombeeEvent.RATING, RecombeeEvent.DELETE_RATING):
+        return 'rating', event.user_id, event.room_id
+    return 'view', event.id
+
+
+def get_event_requests(events, rooms):
+    """ the requests of the final state of events with the same key, in the order they should be sent """
+    last = events[-1]
+    timestamp = last.created.timestamp()
+    # something was sent before, the old state is deleted first
+    replaces = len(events) > 1
+    if last.kind == RecombeeEvent.ADD_USER:
+        return [AddUser(last.user_id)]
+    if last.kind == RecombeeEvent.DETAIL_VIEW:
+        return [AddDetailView(last.user_id, last.room_id, timestamp=timestamp, cascade_create=True)]
+    if last.kind == RecombeeEvent.PURCHASE:
+        add = AddPurchase(last.user_id, last.room_id, timestamp=timestamp, cascade_create=True)
+        return [DeletePurchase(last.user_id, last.room_id), add] if replaces else [add]
+    if last.kind == RecombeeEvent.RATING:
+        add = AddRating(last.user_id, last.room_id, normalize_user_rating(last.rating), timestamp=timestamp,
+                        cascade_create=True)
+        return [DeleteRating(last.user_id, last.room_id), add] if replaces else [add]
+    if last.kind == RecombeeEvent.DELETE_PURCHASE:
+        return [DeletePurchase(last.user_id, last.room_id)]
+    if last.kind == RecombeeEvent.DELETE_RATING:
+        return [DeleteRating(last.user_id, last.room_id)]
+    if last.room_id not in rooms:
+        # the room was deleted since
+        return []
+    return [SetItemValues(str(last.room_id), serialized_room_to_relevant_info_serial(rooms[last.room_id]),
+                          cascade_create=True)]
+
+
+def coalesce_events(events):
+    """
+    the recombee requests of the events, each with the events it reports
+    the events with the same key become the requests of their final state, at the place of the first of them
+    """
+    grouped = {}
+    for event in events:
+        grouped.setdefault(get_event_key(event), []).append(event)
+    room_ids = [event.room_id for event in events if event.kind == RecombeeEvent.ROOM_VALUES]
+    rooms = {room['id']: room for room in RoomSerializer(Room.objects.filter(id__in=room_ids), many=True).data}
+    requests = []
+    for key_events in grouped.values():
+        requests += [(request, key_events) for request in get_event_requests(key_events, rooms)]
+    return requests
+
+
+def retry_events(events, error):
+    now = timezone.now()
+    for event in events:
+        event.attempts += 1
+        event.next_attempt = now + RETRY_DELAY * 2 ** (event.attempts - 1)
+        event.failed = event.attempts >= MAX_ATTEMPTS
+        event.last_error = error
+    RecombeeEvent.objects.bulk_update(events, ['attempts', 'next_attempt', 'failed', 'last_error'])
+
+
+def add_pending_events(events, now):
+    """
+    the due events with the pending events of their keys that wait for a retry
+    the events of a key are always sent together as their final state, so a retried event never overwrites a newer one
+    """
+    keys = {get_event_key(event) for event in events}
+    related = Q(user_id__in={event.user_id for event in events}) | Q(room_id__in={event.room_id for event in events})
+    waiting = RecombeeEvent.objects.filter(related, failed=False, next_attempt__gt=now)
+    waiting = [event for event in waiting if get_event_key(event) in keys]
+    return sorted(events + waiting, key=lambda event: event.id)
+
+
+def send_events(client=None, batch_size=BATCH_SIZE):
+    """
+    send the due events of the outbox in one batch, the delivered events are removed and the others retried later
+    a single worker should run it, the events are removed only after they were sent so none is lost on a crash
+    return - the number of events taken from the outbox
+    """
+    now = timezone.now()
+    events = list(RecombeeEvent.objects.filter(failed=False, next_attempt__lte=now).order_by('id')[:batch_size])
+    if not events:
+        return 0
+    events = add_pending_events(events, now)
+    requests = coalesce_events(events)
+    failed = {}
+    if requests:
+        client = client or get_recombee_client()
+        try:
+            responses = client.send(Batch([request for request, request_events in requests]))
+        except Exception as error:
+            retry_events(events, str(error))
+            return len(events)
+        for (request, request_events), response in zip(requests, responses):
+            if not is_delivered(request, response):
+                for event in request_events:
+                    failed[event.id] = (event, '{} {}'.format(response['code'], response.get('json')))
+    RecombeeEvent.objects.filter(id__in=[event.id for event in events if event.id not in failed]).delete()
+    for event, error in failed.values():
+        retry_events([event], error)
+    return len(events)
@@ -1,6 +1,12 @@
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+import inspect
 import json
+import threading
 
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
 from recombee_api_client.api_client import RecombeeClient
 from recombee_api_client.api_requests import *
 
@@ -16,6 +22,11 @@ NOT_DONE = -100
 RECOMMENDATION_BOOSTER = "if 'totalRating' <= 2 then 0.2 else " \
                          "(if 'totalRating' <= 5 then 0.5 else " \
                          "(if 'totalRating' <= 8 then 0.8 else 1.1))"
+# the requests that are done when recombee already has what they add, or does not have what they delete
+ALREADY_DONE_CODES = {
+    AddUser: 409, AddDetailView: 409, AddPurchase: 409, AddRating: 409, AddItemProperty: 409, DeletePurchase: 404,
+    DeleteRating: 404,
+}
 
 
 # deserializing a JSON into a dictionary
@@ -64,20 +75,157 @@ def normalize_user_rating(user_rating):
     return final_rating
 
 
+class PooledRecombeeClient(RecombeeClient):
+    """
+    a RecombeeClient that sends through one requests session instead of opening a connection per request,
+    the connections of the session pool are kept alive and reused by all the threads
+    """
+
+    # params:
+    # ensure_https - False sends the requests recombee wants over https (the batches) with the protocol of the client
+    #                too, only for a local fake recombee
+    # the pool size and the timeouts are the RECOMBEE_ settings
+    def __init__(self, database_id, token, ensure_https=True, **kwargs):
+        super().__init__(database_id, token, **kwargs)
+        self.connect_timeout = settings.RECOMBEE_CONNECT_TIMEOUT
+        self.read_timeout = settings.RECOMBEE_READ_TIMEOUT
+        self.ensure_https = ensure_https
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.RECOMBEE_POOL_SIZE)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def send_http(self, method, request, uri, timeout, with_body=True):
+        """ the http part of RecombeeClient.send, through the session """
+        headers = self._RecombeeClient__get_http_headers({"Content-Type": "application/json"} if with_body else None)
+        data = json.dumps(self._RecombeeClient__get_body_parameters(request)) if with_body else None
+        if not self.ensure_https:
+            uri = self.protocol + uri[uri.index('://'):]
+        response = self.session.request(method, uri, data=data, headers=headers,
+                                        timeout=(self.connect_timeout, self.read_timeout or timeout))
+        self._RecombeeClient__check_errors(response, request)
+        return response.json()
+
+    # RecombeeClient sends each method with a module level requests call, they are replaced here
+    def _RecombeeClient__put(self, request, uri, timeout):
+        return self.send_http('put', request, uri, timeout)
+
+    def _RecombeeClient__get(self, request, uri, timeout):
+        return self.send_http('get', request, uri, timeout, with_body=False)
+
+    def _RecombeeClient__post(self, request, uri, timeout):
+        return self.send_http('post', request, uri, timeout)
+
+    def _RecombeeClient__delete(self, request, uri, timeout):
+        return self.send_http('delete', request, uri, timeout)
+
+    def close(self):
+        self.session.close()
+
+
+# PooledRecombeeClient replaces private methods of RecombeeClient, their names and arguments are those of
+# recombee-api-client 6.x, another version has to fail here rather than send requests the wrong way
+RECOMBEE_CLIENT_PRIVATES = {
+    '__put': ['self', 'request', 'uri', 'timeout'],
+    '__get': ['self', 'request', 'uri', 'timeout'],
+    '__post': ['self', 'request', 'uri', 'timeout'],
+    '__delete': ['self', 'request', 'uri', 'timeout'],
+    '__get_http_headers': ['self', 'additional_headers'],
+    '__get_body_parameters': ['request'],
+    '__check_errors': ['self', 'response', 'request'],
+}
+for private_name, private_parameters in RECOMBEE_CLIENT_PRIVATES.items():
+    private_method = getattr(RecombeeClient, '_RecombeeClient' + private_name, None)
+    if private_method is None or list(inspect.signature(private_method).parameters) != private_parameters:
+        raise ImportError('PooledRecombeeClient needs recombee-api-client 6.x, RecombeeClient.{} has changed'
+                          .format(private_name))
+
+
+shared_client = None
+shared_client_lock = threading.Lock()
+
+
+def get_recombee_client():
+    """ the recombee client of the process, created on the first use """
+    global shared_client
+    if shared_client is None:
+        with shared_client_lock:
+            if shared_client is None:
+                shared_client = PooledRecombeeClient(DB_NAME, API_KEY)
+    return shared_client
+
+
+def set_recombee_client(client):
+    """
+    replace the recombee client of the process, the tests use it to send to a fake recombee
+    None creates a new client on the next use
+    return - the replaced client, to be set back later
+    """
+    global shared_client
+    with shared_client_lock:
+        replaced, shared_client = shared_client, client
+    return replaced
+
+
+def is_delivered(request, response):
+    """ whether a request of a batch did what it should, response is its {'code', 'json'} item of the batch """
+    return response['code'] in (200, 201) or response['code'] == ALREADY_DONE_CODES.get(type(request))
+
+
 class RecombeeIntegrationClient:
     recombee_client = None
+    batched_requests = None
 
-    # initializing a recombee client to send data from
+    # using the recombee client of the process to send data from
     def __init__(self):
-        print("recombee client was initiatlized")
-        client = RecombeeClient(DB_NAME, API_KEY)
-        self.recombee_client = client
+        self.recombee_client = get_recombee_client()
+
+    # collecting the requests sent in the block, they are sent in their order as one batch at its end
+    # a nested block joins the outer one, nothing is sent when the block raises
+    @contextmanager
+    def batch(self):
+        if self.batched_requests is not None:
+            yield self
+            return
+        self.batched_requests = []
+        try:
+            yield self
+            requests_to_batch = self.batched_requests
+        finally:
+            self.batched_requests = None
+        self.send_batch(requests_to_batch)
+
+    # sending a request, or adding it to the batch of the current block
+    # return - the response, None when the request was batched
+    def send(self, request):
+        if self.batched_requests is not None:
+            self.batched_requests.append(request)
+            return None
+        return self.recombee_client.send(request)
+
+    # sending requests as one batch, or adding them to the batch of the current block
+    # a request that fails does not fail the others
+    # params:
+    # requests_to_batch - the requests in the order recombee should run them
+    # return - (request, response) of the requests that failed, an existing user or a missing rating is not a failure
+    def send_batch(self, requests_to_batch):
+        if self.batched_requests is not None:
+            self.batched_requests.extend(requests_to_batch)
+            return []
+        if not requests_to_batch:
+            return []
+        responses = self.recombee_client.send(Batch(requests_to_batch))
+        failed = [(request, response) for request, response in zip(requests_to_batch, responses)
+                  if not is_delivered(request, response)]
+        for request, response in failed:
+            print("recombee failed", type(request).__name__, request.path, response['code'], response.get('json'))
+        return failed
 
     # sending a user to recombee
     # params:
     # user_id - the id of the new user
     def send_user(self, user_id):
-        self.recombee_client.send(AddUser(user_id))
+        self.send(AddUser(user_id))
 
     # sending the user and the viewed room to recombee for assesment
     # params:
@@ -85,7 +233,7 @@ class RecombeeIntegrationClient:
     # user_id - the viewing user's id
     def send_room_viewing(self, room_id, user_id):
 
-        self.recombee_client.send(
+        self.send(
             AddDetailView(user_id, room_id, cascade_create=True))
         print("sent viewing of a room", room_id, "  of user ", user_id, " to recombee")
 
@@ -96,11 +244,13 @@ class RecombeeIntegrationClient:
     # user_rating the room's rating from [0,10], omit empty if not rated
     def send_room_done_by_user(self, room_id, user_id, user_rating=NOT_DONE):
 
-        self.recombee_client.send(AddPurchase(user_id, room_id, cascade_create=True))
-        # if he also rated the room - add the ratings
+        with self.batch():
+            self.send(AddPurchase(user_id, room_id, cascade_create=True))
+            # if he also rated the room - add the ratings
+            if user_rating != NOT_DONE:
+                self.send(AddRating(user_id, item_id=room_id,
+                                    rating=(normalize_user_rating(user_rating)), cascade_create=True))
         if user_rating != NOT_DONE:
-            self.recombee_client.send(AddRating(user_id, item_id=room_id,
-                                                rating=(normalize_user_rating(user_rating)), cascade_create=True))
             print("sent finishing of a room", room_id, "  of user ", user_id, " to recombee")
 
     # sending the user and the room rating to recombee for assesment
@@ -110,8 +260,8 @@ class RecombeeIntegrationClient:
     # user_rating the room's rating from [0,10]
     def send_room_rating_by_user(self, room_id, user_id, user_rating):
 
-        self.recombee_client.send(AddRating(user_id, item_id=room_id,
-                                            rating=(normalize_user_rating(user_rating)), cascade_create=True))
+        self.send(AddRating(user_id, item_id=room_id,
+                            rating=(normalize_user_rating(user_rating)), cascade_create=True))
 
         print("sent ratings of room:", room_id, "of user:", user_id, "to recombee")
 
@@ -120,7 +270,7 @@ class RecombeeIntegrationClient:
     # room_id - the room's id
     # user_id - the user's id
     def cancel_room_done_by_user(self, room_id, user_id):
-        self.recombee_client.send(DeletePurchase(user_id, item_id=room_id))
+        self.send(DeletePurchase(user_id, item_id=room_id))
         print("canceled finishing of room:", room_id, "of user:", user_id, "to recombee")
 
     # updating the user and the room rating to recombee for assesment
@@ -129,9 +279,10 @@ class RecombeeIntegrationClient:
     # user_id - the user's id
     # user_rating the room's rating from [0,10]
     def update_room_rating_by_user(self, room_id, user_id, user_rating):
-        # TODO maybe batch?
-        self.cancel_room_rating_by_user(room_id, user_id)
-        self.send_room_rating_by_user(room_id, user_id, user_rating)
+        # the old rating is deleted before the new one is added, in the same batch
+        with self.batch():
+            self.cancel_room_rating_by_user(room_id, user_id)
+            self.send_room_rating_by_user(room_id, user_id, user_rating)
 
         print("updated ratings of room:", room_id, "of user:", user_id, "to recombee")
 
@@ -140,7 +291,7 @@ class RecombeeIntegrationClient:
     # room_id - the room's id
     # user_id - the user's id
     def cancel_room_rating_by_user(self, room_id, user_id):
-        self.recombee_client.send(DeleteRating(user_id, item_id=room_id))
+        self.send(DeleteRating(user_id, item_id=room_id))
         print("canceled rating of room:", room_id, "of user:", user_id, "to recombee")
 
     # initializing a room with the relevant details and sending to recombee
@@ -148,15 +299,16 @@ class RecombeeIntegrationClient:
     # serialized_room - the room as a serialized JSON
     def init_room_details(self):
 
-        # adding necessary fields to the room
-        # self.recombee_client.send((AddItemProperty('id','double')))
-        self.recombee_client.send(AddItemProperty('name', 'string'))
-        self.recombee_client.send(AddItemProperty('totalRating', 'double'))
-        self.recombee_client.send(AddItemProperty('scary_rank', 'double'))
-        self.recombee_client.send(AddItemProperty('difficulty_rank', 'double'))
-        self.recombee_client.send(AddItemProperty('is_culinary', 'boolean'))
-        self.recombee_client.send(AddItemProperty('minimal_people_amount', 'double'))
-        self.recombee_client.send(AddItemProperty('maximal_people_amount', 'double'))
+        # adding necessary fields to the room, the fields that already exist are kept
+        # self.send((AddItemProperty('id','double')))
+        with self.batch():
+            self.send(AddItemProperty('name', 'string'))
+            self.send(AddItemProperty('totalRating', 'double'))
+            self.send(AddItemProperty('scary_rank', 'double'))
+            self.send(AddItemProperty('difficulty_rank', 'double'))
+            self.send(AddItemProperty('is_culinary', 'boolean'))
+            self.send(AddItemProperty('minimal_people_amount', 'double'))
+            self.send(AddItemProperty('maximal_people_amount', 'double'))
 
     # updating a room with the relevant details and sending to recombee
     # use when updating room ranks or getting new information about it
@@ -167,18 +319,18 @@ class RecombeeIntegrationClient:
         room_details = serialized_json_to_dict(serialized_room)
         room_json = serialized_room_to_relevant_info_serial(room_details)
         # sending relevant information to recombee
-        self.recombee_client.send(SetItemValues(room_details['id'],
-                                                room_json,
-                                                cascade_create=True
-                                                ))
+        self.send(SetItemValues(room_details['id'],
+                                room_json,
+                                cascade_create=True
+                                ))
 
     # updating a room rating after a user rated the room
     # params:
     # serialized_room - the room as a serialized JSON
     def update_room_rating(self, serialized_room):
-        self.recombee_client.send(SetItemValues(str(serialized_room.data['id']),
-                                                serialized_room_to_relevant_info_serial(serialized_room.data),
-                                                cascade_create=True))
+        self.send(SetItemValues(str(serialized_room.data['id']),
+                                serialized_room_to_relevant_info_serial(serialized_room.data),
+                                cascade_create=True))
 
     # returning a recommendation of 5 rooms to the user sing recombee's AI
     # params:
@@ -190,6 +342,23 @@ class RecombeeIntegrationClient:
                                                  booster=RECOMMENDATION_BOOSTER))
         return recommended['recomms']
 
+    # returning a recommendation of rooms to the user, with the id recombee gave it
+    # params:
+    # user-id - the user which requested the recommendation
+    # return - (the recomm id to ask for the next rooms, the recommended room ids)
+    def get_recommendation_ids(self, user_id):
+        recommended = self.recombee_client.send(RecommendItemsToUser(user_id, RECOMMENDATION_SIZE,
+                                                                     booster=RECOMMENDATION_BOOSTER))
+        return recommended['recommId'], [room['id'] for room in recommended['recomms']]
+
+    # returning the next rooms of a recommendation, after the rooms it already returned
+    # params:
+    # recomm_id - the id of the recommendation from get_recommendation_ids
+    # return - the recommended room ids
+    def get_next_recommendation_ids(self, recomm_id):
+        recommended = self.recombee_client.send(RecommendNextItems(recomm_id, RECOMMENDATION_SIZE))
+        return [room['id'] for room in recommended['recomms']]
+
     ####### PIPELINE FUNCTIONS #######
 
     # sends all the rooms from the db to recombee in a batch
@@ -204,7 +373,7 @@ class RecombeeIntegrationClient:
             request = SetItemValues(room_details['id'], relevant_room_info, cascade_create=True)
             requests_to_batch.append(request)
 
-        self.recombee_client.send(Batch(requests_to_batch))
+        self.send_batch(requests_to_batch)
         print("finished sending batched rooms to recombee..")
 
     # sends add the users from the db to recombee in a batch
@@ -218,5 +387,5 @@ class RecombeeIntegrationClient:
             request = AddUser(user_details['id'])
             requests_to_batch.append(request)
 
-        self.recombee_client.send(Batch(requests_to_batch))
+        self.send_batch(requests_to_batch)
         print("finished sending batched users to recombee..")
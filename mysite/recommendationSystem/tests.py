@@ -1,3 +1,290 @@
-from django.test import TestCase
+import threading
+import time
 
-# Create your tests here.
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from recombee_api_client.api_requests import AddUser, AddDetailView, AddPurchase, AddRating, DeleteRating, \
+    SetItemValues, AddItemProperty, RecommendItemsToUser, RecommendNextItems
+from rest_framework import status
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APITestCase
+
+from core.models import Room, Review, User
+from core.serializers import RoomSerializer
+from .cache import RecommendationCache, recommendation_cache
+from .fake_recombee import FakeRecombeeServer
+from .models import RecombeeEvent
+from .outbox import RecombeeOutbox, coalesce_events, send_events
+from .recombeeIntegration import DB_NAME, API_KEY, RecombeeIntegrationClient, PooledRecombeeClient, \
+    get_recombee_client, set_recombee_client
+
+
+class RecommendationSystemTest(APITestCase):
+    fixtures = ['roomTestData.json', ]
+
+    def setUp(self):
+        data = {'email': 'test@gmail.com', 'password': 'test1234',
+                'last_name': 'test last name', 'first_name': 'test first name'}
+        User.objects.create_user(**data)
+
+    def test_recombee_outbox(self):
+        """
+        Ensure the recombee events are written with their changes, coalesced and retried until delivered.
+        """
+        user = User.objects.get(email='test@gmail.com')
+        token = Token.objects.create(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        url = '/api/room/1/review/'
+        response = self.client.post(url, data={'totalRating': 11})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(RecombeeEvent.objects.exists())
+
+        response = self.client.post(url, data={'totalRating': 9})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.patch(url + str(response.data['id']) + '/', data={'totalRating': 4}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(['purchase', 'rating', 'room_values', 'delete_rating', 'rating', 'room_values'],
+                         list(RecombeeEvent.objects.order_by('id').values_list('kind', flat=True)))
+
+        requests = coalesce_events(list(RecombeeEvent.objects.order_by('id')))
+        self.assertEqual([AddPurchase, DeleteRating, AddRating, SetItemValues],
+                         [type(request) for request, events in requests])
+        self.assertEqual(-0.2, requests[2][0].rating)
+        self.assertEqual('1', requests[3][0].item_id)
+
+        class RecordingClient:
+            def send(self, batch):
+                self.batch = batch
+                # the purchase is already in recombee, the rating fails
+                return [{'code': 409 if isinstance(request, AddPurchase) else 200} for request in batch.requests[:2]] \
+                    + [{'code': 500, 'json': 'error'}, {'code': 200}]
+
+        client = RecordingClient()
+        self.assertEqual(6, send_events(client))
+        self.assertEqual(4, len(client.batch.requests))
+        retried = RecombeeEvent.objects.order_by('id')
+        self.assertEqual(['rating', 'delete_rating', 'rating'], [event.kind for event in retried])
+        self.assertEqual([1, 1, 1], [event.attempts for event in retried])
+        self.assertEqual('500 error', retried[0].last_error)
+        # not due yet
+        self.assertEqual(0, send_events(client))
+
+        # every view of a room is an interaction of its own, with its own time
+        RecombeeEvent.objects.all().delete()
+        RecombeeOutbox().send_room_viewing(1, user.id)
+        RecombeeOutbox().send_room_viewing(1, user.id)
+        requests = coalesce_events(list(RecombeeEvent.objects.order_by('id')))
+        self.assertEqual([AddDetailView, AddDetailView], [type(request) for request, events in requests])
+
+    def test_recombee_batching(self):
+        """
+        Ensure the requests of a batching block are sent in order as one batch, and expected errors do not fail it.
+        """
+        class RecordingClient:
+            batches = []
+
+            def send(self, batch):
+                self.batches.append(batch)
+                # the user and the properties already exist and there is no rating to delete
+                codes = {AddUser: 409, AddItemProperty: 409, DeleteRating: 404, AddPurchase: 500}
+                return [{'code': codes.get(type(request), 200), 'json': 'error'} for request in batch.requests]
+
+        client = RecordingClient()
+        replaced = set_recombee_client(client)
+        try:
+            integration_client = RecombeeIntegrationClient()
+            integration_client.update_room_rating_by_user(1, 2, 8)
+            integration_client.init_room_details()
+            self.assertEqual([[DeleteRating, AddRating], [AddItemProperty] * 7],
+                             [[type(request) for request in batch.requests] for batch in client.batches])
+
+            client.batches.clear()
+            with integration_client.batch():
+                integration_client.send_user(2)
+                integration_client.send_room_done_by_user(1, 2, 8)
+            self.assertEqual([[AddUser, AddPurchase, AddRating]],
+                             [[type(request) for request in batch.requests] for batch in client.batches])
+            failed = integration_client.send_batch([AddUser(3), AddPurchase(3, 1)])
+            self.assertEqual([AddPurchase], [type(request) for request, response in failed])
+
+            client.batches.clear()
+            with self.assertRaises(ValueError):
+                with integration_client.batch():
+                    integration_client.send_user(2)
+                    raise ValueError()
+            self.assertEqual([], client.batches)
+        finally:
+            set_recombee_client(replaced)
+
+        # the outbox events of a view are written together
+        token = Token.objects.create(user=User.objects.get(email='test@gmail.com'))
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/room/1/review/', data={'totalRating': 9})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(1, len([query for query in queries if 'INSERT INTO "recommendationSystem_recombeeevent"'
+                                 in query['sql']]))
+        self.assertEqual(3, RecombeeEvent.objects.count())
+
+    def test_recommendation_cache(self):
+        """
+        Ensure the recommendations are cached per user until they play a room, and the next pages use the recomm id.
+        """
+        class RecommendingClient:
+            requests = []
+
+            def send(self, request):
+                self.requests.append(request)
+                if isinstance(request, RecommendItemsToUser):
+                    return {'recommId': 'first', 'recomms': [{'id': str(room_id)} for room_id in range(10, 0, -1)]}
+                return {'recommId': 'next', 'recomms': [{'id': str(room_id)} for room_id in range(11, 21)]}
+
+        client = RecommendingClient()
+        replaced = set_recombee_client(client)
+        recommendation_cache.clear()
+        try:
+            token = Token.objects.create(user=User.objects.get(email='test@gmail.com'))
+            self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+            url = '/api/recommendation/personalized'
+            for _ in range(3):
+                response = self.client.get(url, {'fields': 'id'})
+                self.assertEqual(list(range(10, 0, -1)), [room['id'] for room in response.data])
+            self.assertEqual([RecommendItemsToUser], [type(request) for request in client.requests])
+            stats = recommendation_cache.stats()
+            self.assertEqual((2, 1), (stats['hits'], stats['misses']))
+            self.assertGreater(stats['average_hit_ms'], 0)
+
+            for _ in range(2):
+                response = self.client.get(url, {'fields': 'id', 'page': 2})
+                self.assertEqual(list(range(11, 21)), [room['id'] for room in response.data])
+            self.assertEqual([RecommendItemsToUser, RecommendNextItems], [type(request) for request in client.requests])
+            self.assertEqual('first', client.requests[1].recomm_id)
+
+            # a new game drops the cached recommendation, and the played room is not recommended
+            response = self.client.post('/api/user/game/', data={'room': 3})
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            response = self.client.get(url, {'fields': 'id'})
+            self.assertEqual([10, 9, 8, 7, 6, 5, 4, 2, 1], [room['id'] for room in response.data])
+            self.assertEqual(3, len(client.requests))
+        finally:
+            set_recombee_client(replaced)
+            recommendation_cache.clear()
+
+        # an invalidation in another process reaches the entries of this one through the shared cache
+        cache, other_process_cache = RecommendationCache(), RecommendationCache()
+        cache.set(1, 'a', ['1'])
+        self.assertEqual(('a', ['1']), cache.get(1))
+        other_process_cache.invalidate(1)
+        self.assertIsNone(cache.get(1))
+
+        # least recently used users are evicted
+        cache = RecommendationCache(size=2)
+        cache.set(1, 'a', ['1'])
+        cache.set(2, 'b', ['2'])
+        cache.get(1)
+        cache.set(3, 'c', ['3'])
+        self.assertEqual([1, 3], list(cache.entries))
+        cache.ttl = 0
+        cache.set(1, 'a', ['1'])
+        self.assertIsNone(cache.get(1))
+
+    def test_fake_recombee(self):
+        """
+        Ensure the outbox events and the recommendations go through a local fake recombee, with its injected errors.
+        """
+        user = User.objects.get(email='test@gmail.com')
+        token = Token.objects.create(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        recommendation_cache.clear()
+        with FakeRecombeeServer() as server, server.as_recombee():
+            fake = server.recombee
+            RecombeeIntegrationClient().init_room_details()
+            self.assertEqual(7, len(fake.item_properties))
+
+            response = self.client.post('/api/room/1/review/', data={'totalRating': 9})
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertEqual(3, send_events())
+            self.assertFalse(RecombeeEvent.objects.exists())
+            user_id = str(user.id)
+            self.assertEqual({(user_id, '1')}, fake.purchases)
+            self.assertEqual({(user_id, '1'): 0.8}, fake.ratings)
+            self.assertEqual(Room.objects.get(id=1).name, fake.items['1']['name'])
+
+            # the rooms are recommended from the fake, without the rated one
+            for room_id in (2, 3):
+                RecombeeIntegrationClient().update_room_details({**RoomSerializer(Room.objects.get(id=room_id)).data,
+                                                                 'totalRating': room_id})
+            response = self.client.get('/api/recommendation/personalized', {'fields': 'id'})
+            self.assertEqual([3, 2], [room['id'] for room in response.data])
+
+            # the failed items of the batch are retried, the missing rating of a delete is not a failure
+            server.fail(500, '/ratings/')
+            response = self.client.patch('/api/room/1/review/{}/'.format(Review.objects.get().id),
+                                         data={'totalRating': 4}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            send_events()
+            self.assertEqual(['delete_rating', 'rating'],
+                             list(RecombeeEvent.objects.order_by('id').values_list('kind', flat=True)))
+            self.assertEqual({(user_id, '1'): 0.8}, fake.ratings)
+            RecombeeEvent.objects.update(next_attempt=timezone.now())
+            send_events()
+            self.assertFalse(RecombeeEvent.objects.exists())
+            self.assertEqual({(user_id, '1'): -0.2}, fake.ratings)
+
+            # a newer event does not overtake an older one that waits for its retry
+            server.fail(500, '/ratings/')
+            response = self.client.patch('/api/room/1/review/{}/'.format(Review.objects.get().id),
+                                         data={'totalRating': 6}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            send_events()
+            self.assertEqual({(user_id, '1'): -0.2}, fake.ratings)
+            response = self.client.delete('/api/room/1/review/{}/'.format(Review.objects.get().id))
+            self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+            send_events()
+            self.assertFalse(RecombeeEvent.objects.exists())
+            RecombeeEvent.objects.update(next_attempt=timezone.now())
+            send_events()
+            self.assertEqual({}, fake.ratings)
+
+            # a failed batch is retried as a whole
+            server.error_rate = 1
+            RecombeeOutbox().send_user(user.id)
+            send_events()
+            self.assertEqual([1], [event.attempts for event in RecombeeEvent.objects.all()])
+            server.error_rate = 0
+
+            server.latency = 0.05
+            start = time.perf_counter()
+            RecombeeIntegrationClient().send_user(user.id + 1)
+            self.assertGreaterEqual(time.perf_counter() - start, 0.05)
+        recommendation_cache.clear()
+
+    def test_shared_recombee_client(self):
+        """
+        Ensure the threads share one lazily created recombee client, and the tests can replace it.
+        """
+        replaced = set_recombee_client(None)
+        try:
+            clients = []
+            threads = [threading.Thread(target=lambda: clients.append(get_recombee_client())) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertIsInstance(clients[0], PooledRecombeeClient)
+            self.assertEqual(1, len({id(client) for client in clients}))
+            self.assertIs(clients[0], RecombeeIntegrationClient().recombee_client)
+
+            fake = object()
+            self.assertIs(clients[0], set_recombee_client(fake))
+            self.assertIs(fake, RecombeeIntegrationClient().recombee_client)
+        finally:
+            set_recombee_client(replaced)
+
+        # the pool and the timeouts come from the settings
+        with override_settings(RECOMBEE_POOL_SIZE=2, RECOMBEE_CONNECT_TIMEOUT=1, RECOMBEE_READ_TIMEOUT=5):
+            client = PooledRecombeeClient(DB_NAME, API_KEY)
+        self.assertEqual((1, 5), (client.connect_timeout, client.read_timeout))
+        self.assertEqual(2, client.session.get_adapter('https://').poolmanager.connection_pool_kw['maxsize'])
+        client.close()
@@ -11,4 +11,5 @@ app_name = 'recommendationSystem'
 urlpatterns = [
     path('personalized', views.personalizedRecommendationView.as_view(), name='personalized'),
     path('popular', views.generalRecommendationView.as_view(), name='popular'),
+    path('cache', views.recommendationCacheView.as_view(), name='cache'),
 ]
\ No newline at end of file
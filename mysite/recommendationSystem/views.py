@@ -1,5 +1,8 @@
-from django.db.models import Q
+from time import perf_counter
+
+from django.db.models import Exists, OuterRef
 from rest_framework import authentication, permissions, status
+from recommendationSystem.cache import recommendation_cache
 from recommendationSystem.recombeeIntegration import RECOMMENDATION_SIZE
 from recommendationSystem.recombeeIntegration import RecombeeIntegrationClient
 from rest_framework import authentication, permissions, status
@@ -7,7 +10,11 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 from core import serializers
 from core.models import Room, Game
-from core.serializers import RoomSerializer
+from core.serializers import RoomSerializer, get_rated_room_ids, get_room_fields, only_room_fields, \
+    is_field_requested
+from core.params import get_float_param
+
+MAX_RECOMMENDATION_PAGE = 5
 
 
 # converts a serialization of a model to a list of a specific field
@@ -25,32 +32,79 @@ class generalRecommendationView(APIView):
     authentication_classes = (authentication.TokenAuthentication,)
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
     def get(self, request, format=None):
+        fields = get_room_fields(request.query_params)
+        # the most popular rooms first, read in the order of the popularity index
+        rooms = only_room_fields(Room.objects.all(), fields).order_by('-popularity_score', '-id')
         if request.user.is_anonymous:
-            queryset = Room.objects.all().order_by('-totalRating')[:RECOMMENDATION_SIZE]
+            queryset = rooms[:RECOMMENDATION_SIZE]
         else:
-            already_played = Game.objects.filter(user__id=request.user.id).values_list('room_id', flat=True).distinct()
-            queryset = Room.objects.filter(~Q(id__in=already_played)).order_by('-totalRating')[:RECOMMENDATION_SIZE]
-        serializer = RoomSerializer(queryset, many=True, context={'request': request})
+            # the rooms the user played are skipped with a NOT EXISTS lookup on the (user, room) index of the games
+            already_played = Game.objects.filter(user=request.user.id, room=OuterRef('pk'))
+            queryset = rooms.annotate(already_played=Exists(already_played)).filter(already_played=False)
+            queryset = queryset[:RECOMMENDATION_SIZE]
+        context = {'request': request, 'fields': fields}
+        if not request.user.is_anonymous and is_field_requested(fields, 'already_rated'):
+            context['rated_rooms'] = get_rated_room_ids(request.user)
+        serializer = RoomSerializer(queryset, many=True, context=context)
         return Response(serializer.data)
 
 
 # a recommendation for a logged in user
+# the recommended room ids are cached per user, see recommendationSystem.cache
 class personalizedRecommendationView(APIView):
     # user should be logged in
     authentication_classes = (authentication.TokenAuthentication,)
     permission_classes = (permissions.IsAuthenticated,)
 
     def get(self, request, format=None):
-        client = RecombeeIntegrationClient()
+        start = perf_counter()
         user_id = request.user.id
         if user_id == None:
             return Response('{"message":"User not logged in!"}', status=status.HTTP_401_UNAUTHORIZED)
-        recommended_for_user = client.get_recommendation(user_id)
-        # extracting room ids
-        value_list = []
-        for room in recommended_for_user:
-            value_list.append(room['id'])
-        # get serialized version of all the rooms as json
-        reccomended_rooms_as_json = serializers.RoomSerializer(Room.objects.filter(id__in=value_list), many=True)
-
-        return Response(reccomended_rooms_as_json.data)
+        page = 1
+        if 'page' in request.query_params:
+            page = int(get_float_param(request.query_params, 'page', 1, MAX_RECOMMENDATION_PAGE))
+
+        cached = recommendation_cache.get(user_id)
+        from_cache = cached is not None
+        if from_cache:
+            recomm_id, room_ids = cached
+        else:
+            recomm_id, room_ids = RecombeeIntegrationClient().get_recommendation_ids(user_id)
+            recommendation_cache.set(user_id, recomm_id, room_ids)
+        # the next pages are asked from recombee with the id of the recommendation, so they do not repeat rooms
+        while len(room_ids) < page * RECOMMENDATION_SIZE and len(room_ids) % RECOMMENDATION_SIZE == 0:
+            next_room_ids = RecombeeIntegrationClient().get_next_recommendation_ids(recomm_id)
+            if not next_room_ids:
+                break
+            room_ids = room_ids + next_room_ids
+            recommendation_cache.set(user_id, recomm_id, room_ids, extends=True)
+            from_cache = False
+        value_list = room_ids[(page - 1) * RECOMMENDATION_SIZE:page * RECOMMENDATION_SIZE]
+
+        # get serialized version of all the rooms as json, in the order of the recommendation
+        fields = get_room_fields(request.query_params)
+        context = {'request': request, 'fields': fields}
+        if is_field_requested(fields, 'already_rated'):
+            context['rated_rooms'] = get_rated_room_ids(request.user)
+        # recombee may not have the rooms the user just played yet, they are skipped
+        already_played = Game.objects.filter(user=user_id, room=OuterRef('pk'))
+        rooms = only_room_fields(Room.objects.filter(id__in=value_list), fields)
+        rooms = rooms.annotate(already_played=Exists(already_played)).filter(already_played=False)
+        order = {str(room_id): index for index, room_id in enumerate(value_list)}
+        rooms = sorted(rooms, key=lambda room: order[str(room.id)])
+        reccomended_rooms_as_json = serializers.RoomSerializer(rooms, many=True, context=context)
+
+        data = reccomended_rooms_as_json.data
+        if from_cache:
+            recommendation_cache.add_hit_time(perf_counter() - start)
+        return Response(data)
+
+
+# the hit rate of the recommendation cache of this process and the time of the requests it served
+class recommendationCacheView(APIView):
+    authentication_classes = (authentication.TokenAuthentication,)
+    permission_classes = (permissions.IsAdminUser,)
+
+    def get(self, request, format=None):
+        return Response(recommendation_cache.stats())
@@ -0,0 +1,66 @@
+import os
+import django
+
+os.environ["DJANGO_SETTINGS_MODULE"] = 'mysite.settings'
+django.setup()
+
+from random import Random
+from statistics import median
+from time import perf_counter, sleep
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import setup_test_environment
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from core.models import User
+from recommendationSystem.cache import recommendation_cache
+from recommendationSystem.recombeeIntegration import set_recombee_client
+
+# the users open the home screen again and again, and sometimes log a game which drops their cached recommendation
+# recombee is replaced by a client that answers after RECOMBEE_LATENCY, like the hosted api
+USERS_COUNT = 20
+REQUESTS_COUNT = 500
+GAME_EVERY = 25  # requests
+RECOMBEE_LATENCY = 0.05  # seconds
+
+
+class SlowRecombeeClient:
+    def send(self, request):
+        sleep(RECOMBEE_LATENCY)
+        return {'recommId': 'benchmark', 'recomms': [{'id': str(room_id)} for room_id in range(1, 11)]}
+
+
+def get_client(user_number):
+    user = User.objects.create_user(email='user{}@benchmark.com'.format(user_number), password='benchmark',
+                                    first_name='benchmark', last_name='user')
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=user).key)
+    return client
+
+
+setup_test_environment()
+old_name = connection.creation.create_test_db(verbosity=0)
+set_recombee_client(SlowRecombeeClient())
+try:
+    call_command('loaddata', 'roomTestData.json', verbosity=0)
+    clients = [get_client(user_number) for user_number in range(USERS_COUNT)]
+    random = Random(0)
+    times = {True: [], False: []}
+    played_room = 11
+    for request_number in range(REQUESTS_COUNT):
+        client = random.choice(clients)
+        if request_number % GAME_EVERY == 0:
+            client.post('/api/user/game/', data={'room': played_room})
+            played_room += 1
+        hits = recommendation_cache.hits
+        start = perf_counter()
+        response = client.get('/api/recommendation/personalized')
+        times[recommendation_cache.hits > hits].append(perf_counter() - start)
+        assert response.status_code == 200, response.data
+    stats = recommendation_cache.stats()
+    print('{} requests of {} users, hit rate {:.0%}'.format(REQUESTS_COUNT, USERS_COUNT, stats['hit_rate']))
+    print('hits: {}, median {:.1f}ms, view time {:.1f}ms'.format(len(times[True]), median(times[True]) * 1000,
+                                                                   stats['average_hit_ms']))
+    print('misses: {}, median {:.1f}ms'.format(len(times[False]), median(times[False]) * 1000))
+finally:
+    connection.creation.destroy_test_db(old_name, verbosity=0)
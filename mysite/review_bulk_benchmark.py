@@ -0,0 +1,72 @@
+import os
+import django
+
+os.environ["DJANGO_SETTINGS_MODULE"] = 'mysite.settings'
+django.setup()
+
+from contextlib import redirect_stdout
+from io import StringIO
+from time import perf_counter
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import setup_test_environment, CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from core.models import User
+from recommendationSystem.fake_recombee import FakeRecombeeServer
+from recommendationSystem.models import RecombeeEvent
+from recommendationSystem.outbox import send_events
+
+# review throughput of ReviewViewSet.create against user/review/bulk, on a test database
+# the views only write outbox events, they are then sent by the worker to a local fake recombee that counts the
+# requests, the sending is not part of the timing
+REVIEWS_COUNT = 100
+
+def get_client(email):
+    user = User.objects.create_user(email=email, password='benchmark', first_name='benchmark', last_name='user')
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=user).key)
+    return client
+
+
+def measure(name, post_reviews, server):
+    events_count = RecombeeEvent.objects.count()
+    with CaptureQueriesContext(connection) as queries, redirect_stdout(StringIO()):
+        start = perf_counter()
+        post_reviews()
+        elapsed = perf_counter() - start
+    events_count = RecombeeEvent.objects.count() - events_count
+    server.recombee.requests.clear()
+    with redirect_stdout(StringIO()):
+        send_events()
+    batches_count = server.recombee.requests.count(('POST', '/batch/'))
+    print('{}: {} reviews in {:.0f}ms, {:.0f} reviews/sec, {} queries, {} outbox events, sent as {} recombee '
+          'requests in {} batches'.format(name, REVIEWS_COUNT, elapsed * 1000, REVIEWS_COUNT / elapsed, len(queries),
+                                          events_count, len(server.recombee.requests) - batches_count, batches_count))
+
+
+def post_single_reviews(client):
+    for room_id in range(1, REVIEWS_COUNT + 1):
+        response = client.post('/api/room/{}/review/'.format(room_id), data={'totalRating': 8, 'scary': 5})
+        assert response.status_code == 201, response.data
+
+
+def post_bulk_reviews(client):
+    reviews = [{'room': room_id, 'totalRating': 8, 'scary': 5} for room_id in range(1, REVIEWS_COUNT + 1)]
+    response = client.post('/api/user/review/bulk/', data=reviews, format='json')
+    assert response.status_code == 201, response.data
+
+
+setup_test_environment()
+old_name = connection.creation.create_test_db(verbosity=0)
+try:
+    call_command('loaddata', 'roomTestData.json', verbosity=0)
+    with redirect_stdout(StringIO()):
+        single_client, bulk_client = get_client('single@benchmark.com'), get_client('bulk@benchmark.com')
+    with FakeRecombeeServer() as server, server.as_recombee():
+        with redirect_stdout(StringIO()):
+            send_events()
+        measure('ReviewViewSet.create', lambda: post_single_reviews(single_client), server)
+        measure('user/review/bulk', lambda: post_bulk_reviews(bulk_client), server)
+finally:
+    connection.creation.destroy_test_db(old_name, verbosity=0)
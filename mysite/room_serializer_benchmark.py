@@ -0,0 +1,27 @@
+import os
+import django
+
+os.environ["DJANGO_SETTINGS_MODULE"] = 'mysite.settings'
+django.setup()
+
+from decimal import Decimal
+from timeit import timeit
+from django.utils import timezone
+from core.models import Room
+from core.serializers import RoomSerializer, RoomValuesSerializer
+
+# serialization time of a room list, no db access - the rooms are built in memory
+columns = RoomValuesSerializer.get_columns(None)
+for rooms_count in [1000, 10000]:
+    rooms = [Room(id=i, name='חדר ' + str(i), description='תיאור ' * 150, address='רחוב ' + str(i), website='site',
+                  telephone_num='03-1234567', owner='owner', city='תל אביב', duration=60,
+                  minimal_people_amount=2, maximal_people_amount=6, latitude=Decimal('32.0853000'),
+                  longitude=Decimal('34.7818000'), pub_date=timezone.now(), room_tile_image='tile',
+                  large_image='image', totalRating=Decimal('17.0'), totalRating_count=2,
+                  scary_rank=Decimal('9.0'), scary_rank_count=2, difficulty_rank=Decimal('3.0'),
+                  difficulty_rank_count=2) for i in range(rooms_count)]
+    rows = [{column: getattr(room, column) for column in columns} for room in rooms]
+    model_time = timeit(lambda: RoomSerializer(rooms, many=True).data, number=3) / 3
+    values_time = timeit(lambda: RoomValuesSerializer(rows).data, number=3) / 3
+    print('{} rooms: RoomSerializer {:.1f}ms, RoomValuesSerializer {:.1f}ms ({:.1f}x)'.format(
+        rooms_count, model_time * 1000, values_time * 1000, model_time / values_time))